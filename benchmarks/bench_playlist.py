@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Wanja Chresta
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+
+"""Benchmark RatedLibrary.create_playlist on synthetic libraries.
+
+Runs headless; neither Quod Libet nor GTK need to be installed. Every case runs in its
+own process so the reported peak memory isn't skewed by the cases before it.
+
+    python benchmarks/bench_playlist.py --output results.json
+    python benchmarks/bench_playlist.py --save-baseline
+    python benchmarks/bench_playlist.py --sizes 1000,10000 --baseline benchmarks/baseline.json
+
+Exits with status 1 if a case calls raters more often (or is slower) than the baseline
+allows, and with status 2 if there is no baseline. The committed baseline's rater calls
+depend neither on the machine nor on numpy, so they are always compared; its timings only
+on the host that recorded it, with numpy installed the same way. Record a baseline of your
+own (see --baseline) to compare timings elsewhere.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, "plugins"))
+
+import weightedPlaylist as wp
+
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+def synthetic_library(size, seed=0):
+    """Songs with realistic tag distributions: about a third without bpm, a few genres and
+    artists with many songs and a long tail of small ones, mostly unrated songs"""
+    rnd = random.Random(seed)
+    library = []
+    for i in xrange(size):
+        song = wp.DumpSong(title="song %d" % i)
+        song["~#length"] = max(30, int(rnd.lognormvariate(5.45, 0.35)))
+        song["~#rating"] = 0.5 if rnd.random() < 0.6 else rnd.choice([0., 0.25, 0.75, 1.])
+        if rnd.random() < 0.65:
+            song["bpm"] = str(int(rnd.gauss(110, 25)))
+        song["genre"] = "genre %d" % int(rnd.paretovariate(1.2))
+        song["artist"] = "artist %d" % int(rnd.paretovariate(0.8))
+        library.append(song)
+    return library
+
+def build_rater():
+    """The rater tree the plugin builds, with all weights in use"""
+    rater = wp.ModifiedAveragedRater()
+    rater.add_rater(weight=60., rater=wp.SongRatingRater())
+    rater.add_rater(weight=30., rater=wp.BpmRater(target_bpm=100, spread=20))
+    rater.add_modifier(weight=3., rater=wp.RepeaterRater())
+    return rater
+
+def current_rss_kb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        return 0
+
+def run_case(library, case, seed, connection):
+    """Run one case in a child process and send the measurements to connection"""
+    start_rss = current_rss_kb()
+    stats = wp.RaterStats()
+    rated_library = wp.RatedLibrary(library, build_rater(), stats)
+    random.seed(seed)
+
+    stdout = sys.stdout
+    if case["debug"]:
+        # Debug output isn't what we want to measure the terminal speed of
+        sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.time()
+        playlist = rated_library.create_playlist(num_items=case["num_items"], play_length=case["play_length"],
+                                                 debug=case["debug"], sampling=case["sampling"])
+        seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    connection.send({
+        "seconds": seconds,
+        "peak_memory_kb": max(0, peak_rss - start_rss),
+        "rater_calls": stats.calls,
+        "phases": stats.phases,
+        "songs": len(playlist),
+    })
+    connection.close()
+
+def cases(sizes, samplings, max_scan_size):
+    for size in sizes:
+        for mode, num_items, play_length in (("num_items", 100, None), ("play_length", None, 5*60*60)):
+            for sampling in samplings:
+                if sampling == "scan" and size > max_scan_size:
+                    continue
+                for debug in (False, True):
+                    yield {
+                        "name": "%s-%s-%s%s" % (size, mode, sampling, "-debug" if debug else ""),
+                        "size": size,
+                        "mode": mode,
+                        "num_items": num_items,
+                        "play_length": play_length,
+                        "sampling": sampling,
+                        "debug": debug,
+                    }
+
+def run(sizes, samplings, max_scan_size, seed):
+    results = []
+    for size in sizes:
+        library = synthetic_library(size, seed)
+        for case in cases([size], samplings, max_scan_size):
+            parent, child = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_case, args=(library, case, seed, child))
+            process.start()
+            case.update(parent.recv())
+            process.join()
+
+            print "%-40s %8.3fs %8i kB %10i rater calls" % (
+                case["name"], case["seconds"], case["peak_memory_kb"], sum(case["rater_calls"].values()))
+            results.append(case)
+
+    return results
+
+def regressions(results, baseline, tolerance, timings=True):
+    """Return descriptions of all cases that call raters more often than the baseline or, with
+    timings, got slower"""
+    problems = []
+    reference = dict((case["name"], case) for case in baseline["results"])
+    for case in results:
+        try:
+            expected = reference[case["name"]]
+        except KeyError:
+            continue
+
+        if timings and case["seconds"] > expected["seconds"] * (1. + tolerance):
+            problems.append("%s: %.3fs (baseline %.3fs)" % (case["name"], case["seconds"], expected["seconds"]))
+
+        calls = sum(case["rater_calls"].values())
+        expected_calls = sum(expected["rater_calls"].values())
+        if calls > expected_calls * (1. + tolerance):
+            problems.append("%s: %i rater calls (baseline %i)" % (case["name"], calls, expected_calls))
+
+    return problems
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark RatedLibrary.create_playlist")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma separated library sizes (default: %(default)s)")
+    parser.add_argument("--sampling", default="scan,rejection",
+                        help="comma separated sampling modes (default: %(default)s)")
+    parser.add_argument("--max-scan-size", type=int, default=100000,
+                        help="skip the scan mode for larger libraries (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="compare against this JSON file (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown (and increase of rater calls) relative to the baseline "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    samplings = args.sampling.split(",")
+
+    report = {
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "numpy": wp.numpy is not None,
+        "seed": args.seed,
+        "results": run(sizes, samplings, args.max_scan_size, args.seed),
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print "No baseline at %s; run with --save-baseline to create one" % args.baseline
+        return 2
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    timings = True
+    if baseline.get("host") != report["host"]:
+        print "Baseline was recorded on %s; only comparing rater calls" % baseline.get("host")
+        timings = False
+    elif baseline.get("numpy") != report["numpy"]:
+        print "Baseline was recorded %s numpy; only comparing rater calls" % ("with" if baseline.get("numpy") else "without")
+        timings = False
+
+    problems = regressions(report["results"], baseline, args.tolerance, timings)
+    for problem in problems:
+        print "REGRESSION", problem
+
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,23 +1,285 @@
 
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import threading
 import time
 
+try:
+    import numpy
+except ImportError:
+    # Only tapping works then
+    numpy = None
+
 if __name__ != "__main__":
     from quodlibet import app
+    from quodlibet import const
     from quodlibet.plugins.songsmenu import SongsMenuPlugin
     from quodlibet.plugins.events import EventPlugin
 
-    from gi.repository import Gtk
+    from gi.repository import Gtk, GLib
 else:
     _ = lambda x: x
 
     class SongsMenuPlugin:
         pass
+    class EventPlugin:
+        pass
     class Gtk:
+        STOCK_FIND_AND_REPLACE = None
         class Window:
             pass
 
+# Audio is decoded to mono at this sample rate for tempo detection
+ANALYSIS_RATE = 11025
+# Frame size and hop (in samples) of the spectra the onsets are detected in
+FRAME_SIZE = 1024
+HOP_SIZE = 256
+
+def decode(path, offset=0., duration=None, rate=ANALYSIS_RATE):
+    """Decode a file with ffmpeg to a numpy array of mono samples in [-1, 1]"""
+    command = ["ffmpeg", "-v", "quiet", "-nostdin"]
+    if offset:
+        command += ["-ss", "%.1f" % offset]
+    command += ["-i", path]
+    if duration:
+        command += ["-t", "%.1f" % duration]
+    command += ["-vn", "-ac", "1", "-ar", str(rate), "-f", "s16le", "-"]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    data, _ = process.communicate()
+    if process.returncode:
+        raise IOError("could not decode %s" % path)
+    return numpy.frombuffer(data, dtype=numpy.int16).astype(numpy.float32) / 32768.
+
+def onset_envelope(samples, rate=ANALYSIS_RATE):
+    """Return the onset strength (spectral flux) of samples per frame and the number of frames
+    per second"""
+    count = 1 + (len(samples) - FRAME_SIZE) // HOP_SIZE
+    if count < 3:
+        return numpy.zeros(0), float(rate) / HOP_SIZE
+
+    # All frames at once, as overlapping views of samples
+    frames = numpy.lib.stride_tricks.as_strided(
+        samples, shape=(count, FRAME_SIZE), strides=(samples.strides[0] * HOP_SIZE, samples.strides[0]))
+    spectrum = numpy.log1p(1000. * numpy.abs(numpy.fft.rfft(frames * numpy.hanning(FRAME_SIZE), axis=1)))
+
+    flux = numpy.maximum(numpy.diff(spectrum, axis=0), 0.).sum(axis=1)
+    # Only keep what rises above the local average
+    flux -= numpy.convolve(flux, numpy.ones(16) / 16., mode='same')
+    return numpy.maximum(flux, 0.), float(rate) / HOP_SIZE
+
+def detect_tempo(envelope, frames_per_second, min_bpm=60., max_bpm=200., resolution=0.25):
+    """Return the bpm at which envelope repeats itself best, or None if it doesn't"""
+    if len(envelope) < 2:
+        return None
+    envelope = envelope - envelope.mean()
+
+    # Autocorrelation using the FFT
+    spectrum = numpy.fft.rfft(envelope, 2 * len(envelope))
+    autocorrelation = numpy.fft.irfft(spectrum * numpy.conj(spectrum))[:len(envelope)]
+
+    # Rate every candidate tempo by the autocorrelation at one and two beats (interpolated
+    # between frames, so the beat doesn't need to fall on a whole number of frames)
+    bpm = numpy.arange(min_bpm, max_bpm + resolution, resolution)
+    lags = 60. * frames_per_second / bpm
+    frames = numpy.arange(len(autocorrelation))
+    score = numpy.zeros(len(bpm))
+    for beats in range(1, 3):
+        score += numpy.interp(beats * lags, frames, autocorrelation, right=0.) / beats
+
+    # Prefer tempos around 120 bpm, against picking half or double the tempo
+    score *= numpy.exp(-0.5 * numpy.log2(bpm / 120.) ** 2)
+    best = int(numpy.argmax(score))
+    if score[best] <= 0.:
+        return None
+    return float(bpm[best])
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fileobj:
+        for block in iter(lambda: fileobj.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# bpm by file hash, known to the worker processes; set by _init_worker
+_known_bpm = {}
+
+def _init_worker(known_bpm):
+    _known_bpm.update(known_bpm)
+
+def analyse(job):
+    """Detect the tempo of a file (in a worker process). job is (path, offset, duration);
+    returns (path, file hash, bpm or None, error message or None)"""
+    path, offset, duration = job
+    try:
+        digest = file_hash(path)
+        if digest in _known_bpm:
+            return path, digest, _known_bpm[digest], None
+        envelope, frames_per_second = onset_envelope(decode(path, offset, duration))
+        return path, digest, detect_tempo(envelope, frames_per_second), None
+    except (EnvironmentError, ValueError), e:
+        return path, None, None, str(e)
+
+def _encode_path(path):
+    """Path as JSON text that _decode_path turns back into the same bytes (or unicode):
+    Quod Libet's file names are bytes in any encoding on most systems, unicode on Windows"""
+    if isinstance(path, unicode):
+        return u"u" + path
+    return u"b" + path.decode("latin-1")
+
+def _decode_path(text):
+    if text.startswith(u"u"):
+        return text[1:]
+    return text[1:].encode("latin-1")
+
+class BpmCache(object):
+    """Detected bpm by file hash, kept in a JSON file; None for files without a detectable
+    tempo, so they aren't analysed again either. Files are also remembered with their mtime
+    and size, so unchanged files aren't even hashed again."""
+
+    # Version of the file format; files of other versions are only used for their bpm
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.bpm = {}
+        self.files = {}
+        try:
+            with open(path) as fileobj:
+                data = json.load(fileobj)
+            self.bpm = data["bpm"]
+            if data.get("version") == self.VERSION:
+                self.files = dict((_decode_path(path), tuple(entry))
+                                  for path, entry in data["files"].iteritems())
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def lookup(self, path, stat):
+        """bpm of an unchanged file analysed before (None if it had no detectable tempo);
+        raises KeyError if the file wasn't analysed or changed since"""
+        mtime, size, digest = self.files[path]
+        if (mtime, size) != (stat.st_mtime, stat.st_size):
+            raise KeyError(path)
+        return self.bpm[digest]
+
+    def add(self, path, stat, digest, bpm):
+        with self.lock:
+            self.files[path] = (stat.st_mtime, stat.st_size, digest)
+            self.bpm[digest] = bpm
+
+    def save(self):
+        with self.lock:
+            temp_path = self.path + ".tmp"
+            files = dict((_encode_path(path), entry) for path, entry in self.files.iteritems())
+            with open(temp_path, "w") as fileobj:
+                json.dump({"version": self.VERSION, "bpm": self.bpm, "files": files}, fileobj)
+            try:
+                os.rename(temp_path, self.path)
+            except OSError:
+                # Windows doesn't replace existing files
+                os.remove(self.path)
+                os.rename(temp_path, self.path)
+
+class BpmDetector(threading.Thread):
+    """Detect the tempo of many songs in a pool of worker processes, in a background thread.
+
+    Only the middle (up to) analysis_length seconds of each song are analysed. The
+    callbacks are called from the GTK main loop: on_result with a song and its bpm,
+    on_progress with the number of songs done and the total, on_done at the end."""
+
+    analysis_length = 60.
+
+    def __init__(self, songs, cache, on_result, on_progress=None, on_done=None, processes=None):
+        super(BpmDetector, self).__init__(name="bpm detection")
+        self.daemon = True
+
+        self.songs = list(songs)
+        self.cache = cache
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.processes = processes or multiprocessing.cpu_count()
+
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            try:
+                self._detect()
+            finally:
+                self.cache.save()
+        finally:
+            # Even if saving the cache failed, so the progress bar goes away
+            GLib.idle_add(self._idle, self.on_done)
+
+    def _detect(self):
+        total = len(self.songs)
+        done = 0
+        songs = {}
+        stats = {}
+        jobs = []
+        for song in self.songs:
+            path = song("~filename")
+            try:
+                stat = os.stat(path)
+            except OSError:
+                done += 1
+                continue
+
+            try:
+                bpm = self.cache.lookup(path, stat)
+            except KeyError:
+                pass
+            else:
+                done += 1
+                if bpm is not None:
+                    GLib.idle_add(self._idle, self.on_result, song, bpm)
+                continue
+
+            length = song("~#length") or 0
+            offset = max(0., (length - self.analysis_length) / 2.)
+            songs[path] = song
+            stats[path] = stat
+            jobs.append((path, offset, self.analysis_length))
+
+        GLib.idle_add(self._idle, self.on_progress, done, total)
+        if not jobs:
+            return
+
+        # Forked workers know the cached bpm of all hashes without copying
+        pool = multiprocessing.Pool(self.processes, _init_worker, (self.cache.bpm,))
+        try:
+            for path, digest, bpm, error in pool.imap_unordered(analyse, jobs):
+                if self.cancelled.is_set():
+                    return
+
+                done += 1
+                if error is not None:
+                    print "Could not detect bpm of %s: %s" % (path, error)
+                else:
+                    self.cache.add(path, stats[path], digest, bpm)
+                    if bpm is not None:
+                        GLib.idle_add(self._idle, self.on_result, songs[path], bpm)
+                GLib.idle_add(self._idle, self.on_progress, done, total)
+        finally:
+            pool.terminate()
+
+    def _idle(self, callback, *args):
+        if callback is not None and not self.cancelled.is_set():
+            callback(*args)
+        return False
+
 class BpmTagger(SongsMenuPlugin, EventPlugin):
-    """Provide a GUI to be able to manually tag songs Beats Per Minute by tapping a button"""
+    """Provide a GUI to be able to manually tag songs Beats Per Minute by tapping a button.
+
+    With more than one song selected, detect the bpm of those without one instead."""
 
     PLUGIN_ID = "bpmtagger"
     PLUGIN_NAME = _("BPM Tagger")
@@ -39,7 +301,12 @@ class BpmTagger(SongsMenuPlugin, EventPlugin):
 
             BpmTagger.win = win
 
-        win.show_all()
+        BpmTagger.win.show_all()
+
+        # Songs tapped by hand keep their bpm
+        untagged = [song for song in songs if not song("bpm")]
+        if len(songs) > 1 and untagged:
+            BpmTagger.win.detect(untagged)
 
     def plugin_on_song_started(self, song):
         print "Song Started"
@@ -99,6 +366,22 @@ class BpmTaggerWindow(Gtk.Window):
         topbox.pack_start(buttonbox, True, True, 0)
         botbox.pack_start(save_button, True, True, 0)
 
+        # batch detection, see detect
+        self.detector = None
+        self.cache = None
+        self.detected = []
+        self.progress = Gtk.ProgressBar()
+        self.progress.set_show_text(True)
+        self.progress.set_no_show_all(True)
+        stop_button = Gtk.Button(label="Stop detection")
+        stop_button.connect("clicked", self.on_stop_clicked)
+        stop_button.set_no_show_all(True)
+        self.stop_button = stop_button
+        detectbox = Gtk.HBox(spacing=10)
+        detectbox.pack_start(self.progress, True, True, 0)
+        detectbox.pack_start(stop_button, False, True, 0)
+        vbox.pack_start(detectbox, True, True, 0)
+
         ## initialisation
         self.reset()
 
@@ -138,8 +421,54 @@ class BpmTaggerWindow(Gtk.Window):
     def on_save_clicked(self, event):
         bpm = int(self.current_bpm)
         self.current_song["bpm"] = str(bpm) # bpm (apparently) is a string attribute
+        # Let the library (and everything listening to it) know the tag changed
+        app.library.changed([self.current_song])
         self.reset()
 
     def on_reset_clicked(self, event):
         self.reset()
 
+    def detect(self, songs):
+        """Detect the bpm of songs in the background and tag them"""
+        if numpy is None:
+            print "Detecting bpm needs numpy"
+            return
+        if self.detector is not None:
+            self.detector.cancel()
+
+        if self.cache is None:
+            self.cache = BpmCache(os.path.join(const.USERDIR, "bpmtagger.cache"))
+        self.detector = BpmDetector(songs, self.cache, self.on_detected, self.on_detect_progress, self.on_detect_done)
+        self.progress.set_fraction(0.)
+        self.progress.set_text("Detecting bpm")
+        self.progress.show()
+        self.stop_button.show()
+        self.detector.start()
+
+    def on_detected(self, song, bpm):
+        song["bpm"] = str(int(round(bpm)))
+        self.detected.append(song)
+        # Let the library know in batches, not once per song
+        if len(self.detected) >= 50:
+            self.flush_detected()
+
+    def flush_detected(self):
+        if self.detected:
+            app.library.changed(self.detected)
+            self.detected = []
+
+    def on_detect_progress(self, done, total):
+        self.progress.set_fraction(float(done) / total if total else 1.)
+        self.progress.set_text("Detected bpm of %i of %i songs" % (done, total))
+
+    def on_detect_done(self):
+        self.flush_detected()
+        self.detector = None
+        self.progress.hide()
+        self.stop_button.hide()
+
+    def on_stop_clicked(self, event):
+        if self.detector is not None:
+            self.detector.cancel()
+        self.on_detect_done()
+
@@ -7,92 +7,476 @@
 # it under the terms of the GNU General Public License version 3 as
 # published by the Free Software Foundation
 
+import bisect
+import collections
+import json
+import mmap
+import multiprocessing
+import operator
+import os
 import random
+import struct
+import sys
+import threading
+import time
+from array import array
+from math import isnan
+
+try:
+    import numpy
+except ImportError:
+    # Raters fall back to rating one song at a time
+    numpy = None
+
+NAN = float('nan')
+
+try:
+    from gi.repository import Gtk, GLib
+
+    from quodlibet.plugins.songsmenu import SongsMenuPlugin
+    from quodlibet import app
+    from quodlibet import config
+    from quodlibet import const
+    from quodlibet import util
+    from quodlibet.qltk.notif import Task
+except ImportError:
+    # Headless (benchmarks, running this file); only the rating and sampling code works
+    SongsMenuPlugin = object
+    app = None
+    _ = lambda x: x
+
+def song_bpm(song):
+    """The bpm of a song as rated; NaN if it has none"""
+    try:
+        return int(song('~#bpm'))
+    except ValueError:
+        return NAN
+
+class SongFeatures(object):
+    """Columnar snapshot of the song attributes the raters look at.
+
+    Numeric values are kept in arrays, text tags are interned to integer ids (songs with
+    equal tags get equal ids). Songs without a valid bpm get NaN as bpm."""
+
+    # Tags interned when the snapshot is taken; others are interned on first use
+    preloaded_tags = ('genre', 'artist')
+
+    def __init__(self, songs):
+        songs = list(songs)
+
+        bpm = array('d')
+        rating = array('d')
+        length = array('d')
+        for song in songs:
+            bpm.append(song_bpm(song))
+            rating.append(song('~#rating'))
+            length.append(song('~#length'))
+
+        self._init(songs, bpm, rating, length, {}, {})
+        for attribute in self.preloaded_tags:
+            self.tag(attribute)
 
-from gi.repository import Gtk
+    @classmethod
+    def from_columns(cls, songs, bpm, rating, length, tags, tag_values):
+        """Snapshot of songs from columns computed before (see FeatureIndex)"""
+        features = cls.__new__(cls)
+        features._init(list(songs), bpm, rating, length, tags, tag_values)
+        return features
+
+    def _init(self, songs, bpm, rating, length, tags, tag_values):
+        self.songs = songs
+        self.index = dict((song, i) for i, song in enumerate(songs))
+
+        self.bpm = bpm
+        self.rating = rating
+        self.length = length
+
+        # attribute -> array of ids, attribute -> list of values (indexed by id)
+        self.tags = tags
+        self.tag_values = tag_values
+
+        # column -> numpy view, see vector
+        self.vectors = {}
+
+    @classmethod
+    def for_playlist(cls, song, song_list):
+        """Snapshot of song_list followed by song; returns it and the History of song_list"""
+        features = cls(list(song_list) + [song])
+        return features, History(features, range(len(song_list)))
+
+    def __len__(self):
+        return len(self.songs)
+
+    def tag(self, attribute):
+        """Ids of the given tag for all songs; interned on first use"""
+        try:
+            return self.tags[attribute]
+        except KeyError:
+            ids = {}
+            column = array('i', (ids.setdefault(song(attribute), len(ids)) for song in self.songs))
+            self.tags[attribute] = column
+            self.tag_values[attribute] = sorted(ids, key=ids.get)
+            return column
+
+    def vector(self, column):
+        """numpy view of a numeric column ('bpm', 'rating' or 'length') or of the ids of a tag"""
+        try:
+            return self.vectors[column]
+        except KeyError:
+            if column in ('bpm', 'rating', 'length'):
+                vector = numpy.frombuffer(getattr(self, column), dtype=numpy.float64)
+            else:
+                vector = numpy.frombuffer(self.tag(column), dtype=numpy.intc)
+            self.vectors[column] = vector
+            return vector
+
+class History(object):
+    """The playlist built so far: indices into a SongFeatures snapshot and the songs themselves"""
+    __slots__ = ("indices", "songs")
+
+    def __init__(self, features, indices=()):
+        self.indices = list(indices)
+        self.songs = [features.songs[i] for i in self.indices]
+
+    def __len__(self):
+        return len(self.indices)
 
-from quodlibet.plugins.songsmenu import SongsMenuPlugin
-from quodlibet import app
-from quodlibet import config
-from quodlibet import util
+    def append(self, features, index):
+        self.indices.append(index)
+        self.songs.append(features.songs[index])
 
 class Rater(object):
-    """Rating machine that gives scores to objects in [0,1] depending on the context"""
+    """Rating machine that gives scores to objects in [0,1] depending on the context.
+
+    Subclasses implement rate, rate_index or both; each defaults to the other."""
     name = None
 
+    # Raters that only look at the song itself (and not at the playlist built so far) set
+    # this to False; they are rated once per playlist run and their scores are cached and
+    # reused for every pick. Raters are assumed to look at the playlist unless they say so.
+    context_dependent = True
+
+    # Upper bound of the scores returned by rate
+    max_score = 1.
+
     def rate(self, obj, context):
         """Return a rating for object in the given context in [0,1]"""
-        raise NotImplementedError
+        if not self._implements("rate_index"):
+            raise NotImplementedError
+        features, history = SongFeatures.for_playlist(obj, context)
+        return self.rate_index(features, len(features) - 1, history)
+
+    def rate_index(self, features, index, history):
+        """Return a rating for song number index of the SongFeatures snapshot, given the History"""
+        if not self._implements("rate"):
+            raise NotImplementedError
+        return self.rate(features.songs[index], history.songs)
+
+    def _implements(self, method):
+        """Whether a subclass overrides method of Rater"""
+        return getattr(type(self), method).im_func is not getattr(Rater, method).im_func
+
+    def rate_batch(self, features, indices, history):
+        """Return a numpy array with the ratings of the songs at the given (numpy array of)
+        indices. Only used if numpy is available; rates one song at a time unless overridden."""
+        return numpy.fromiter((self.rate_index(features, index, history) for index in indices),
+                              dtype=numpy.float64, count=len(indices))
+
+    def support(self, features, history):
+        """Return the indices of all songs that can get a score above 0, or None if that
+        can't be narrowed down"""
+        return None
+
+    def reach(self, features, indices, position):
+        """Return the last position of a playlist (a list of indices) whose score can change
+        when the song at position is changed (see PlaylistOptimizer)"""
+        if not self.context_dependent:
+            return position
+        return len(indices) - 1
+
+    def close(self):
+        """Release what the rater holds on to between picks (see ParallelRater); called at
+        the end of every RatedLibrary.extend"""
+        pass
+
+    def config(self):
+        """Describe everything that changes the scores of this rater (see FeatureIndex): its
+        attributes holding plain values or tuples and lists of them. Raters configured
+        otherwise override this."""
+        values = sorted((key, value) for key, value in vars(self).items() if _plain(value))
+        return "%s%r" % (type(self).__name__, values)
 
     def __repr__(self):
         return self.name
 
+def _plain(value):
+    """Whether value is a scalar or a (nested) tuple or list of scalars"""
+    if isinstance(value, (tuple, list)):
+        return all(_plain(item) for item in value)
+    return isinstance(value, (bool, int, long, float, basestring))
+
 class BpmRater(Rater):
     name = "Bpm"
+    context_dependent = False
 
     def __init__(self, target_bpm=80, spread=20):
         self.target_bpm = target_bpm
         self.spread = spread
 
-    def rate(self, song, song_list):
-        try:
-            song_bpm = int(song('~#bpm'))
-        except ValueError:
+    def rate_index(self, features, index, history):
+        song_bpm = features.bpm[index]
+        if isnan(song_bpm):
             return 0.
 
         raw_rating = 1.-(song_bpm - self.target_bpm)/(2.*self.spread)
         return max(0., raw_rating)
 
+    def rate_batch(self, features, indices, history):
+        song_bpm = features.vector('bpm')[indices]
+        raw_rating = 1.-(song_bpm - self.target_bpm)/(2.*self.spread)
+        raw_rating[numpy.isnan(song_bpm)] = 0.
+        return numpy.maximum(raw_rating, 0.)
+
+class TempoIndex(object):
+    """Songs of a SongFeatures snapshot that have a bpm, sorted by bpm"""
+
+    def __init__(self, features):
+        if numpy is not None:
+            bpm = features.vector('bpm')
+            # argsort puts NaN last
+            self.order = numpy.argsort(bpm, kind='mergesort')[:numpy.count_nonzero(~numpy.isnan(bpm))]
+            self.bpm = bpm[self.order]
+        else:
+            pairs = sorted((bpm, index) for index, bpm in enumerate(features.bpm) if not isnan(bpm))
+            self.order = array('i', (index for _, index in pairs))
+            self.bpm = array('d', (bpm for bpm, _ in pairs))
+
+    def __len__(self):
+        return len(self.order)
+
+    def between(self, low, high):
+        """Indices of the songs with low <= bpm <= high, found by binary search"""
+        if numpy is not None:
+            start = numpy.searchsorted(self.bpm, low, side='left')
+            end = numpy.searchsorted(self.bpm, high, side='right')
+        else:
+            start, end = bisect.bisect_left(self.bpm, low), bisect.bisect_right(self.bpm, high)
+        return self.order[start:end]
+
+class BpmTransitionRater(Rater):
+    """Rate songs by how close their bpm is to the bpm of the song picked last (plus ramp
+    bpm per song, to slowly speed up or calm down the playlist).
+
+    Songs more than window bpm away from that target, or without bpm, get 0. They are
+    never looked at in rate_batch or support; the songs within the window are found by
+    binary search in a TempoIndex. Songs get 1 as long as no song with bpm was picked."""
+    name = "BpmTransition"
+    context_dependent = True
+
+    def __init__(self, window=10., ramp=0.):
+        self.window = window
+        self.ramp = ramp
+
+        # features and TempoIndex of the last snapshot rated
+        self.tempo_index = None
+
+    def _tempo_index(self, features):
+        if self.tempo_index is None or self.tempo_index[0] is not features:
+            self.tempo_index = (features, TempoIndex(features))
+        return self.tempo_index[1]
+
+    def target(self, features, history):
+        """The bpm songs should have to follow the playlist; None if no song had a bpm"""
+        bpm = features.bpm
+        for steps, index in enumerate(reversed(history.indices)):
+            if not isnan(bpm[index]):
+                return bpm[index] + self.ramp * (steps + 1)
+        return None
+
+    def rate_index(self, features, index, history):
+        target = self.target(features, history)
+        if target is None:
+            return 1.
+
+        song_bpm = features.bpm[index]
+        if isnan(song_bpm):
+            return 0.
+        return max(0., 1. - abs(song_bpm - target) / self.window)
+
+    def rate_batch(self, features, indices, history):
+        target = self.target(features, history)
+        if target is None:
+            return numpy.ones(len(indices))
+
+        neighbours = self._tempo_index(features).between(target - self.window, target + self.window)
+        scores = numpy.zeros(len(features))
+        scores[neighbours] = numpy.maximum(1. - numpy.abs(features.vector('bpm')[neighbours] - target) / self.window, 0.)
+        return scores[indices]
+
+    def support(self, features, history):
+        target = self.target(features, history)
+        if target is None:
+            return None
+        return self._tempo_index(features).between(target - self.window, target + self.window)
+
+    def reach(self, features, indices, position):
+        # The songs up to the next one with a bpm follow the song at position
+        bpm = features.bpm
+        for later in xrange(position + 1, len(indices)):
+            if not isnan(bpm[indices[later]]):
+                return later
+        return len(indices) - 1
+
 class SongRatingRater(Rater):
     name = "SongRating"
+    context_dependent = False
 
-    def rate(self, song, song_list):
-        return song("~#rating")
-
-class RepeaterRater(Rater):
-    name = "Repeater"
+    def rate_index(self, features, index, history):
+        return features.rating[index]
 
-    def rate(self, song, song_list):
-        try:
-            last_song = song_list[-1]
-            prelast_song = song_list[-2]
-        except IndexError:
-            return 1.
-        except KeyError:
-            return 1.
+    def rate_batch(self, features, indices, history):
+        return features.vector('rating')[indices]
 
-        total_rating = 0
+# Allow `allowed` songs with the same attribute among the last `window` picks
+RepetitionRule = collections.namedtuple("RepetitionRule", "attribute window allowed weight")
 
-        # How many repetitions are ok?
-        # Second in tuple is weight; weights needs to add to 1
-        # Repetition = 0 attributes force a score of 0 on repetition
-        attributes = { 'genre': (2, 1.), 'artist': (0, 0) } # genre should be repeated twice, arist should never be repeated
-        for attribute, (allowed_repetitions, weight) in attributes.items():
-            this = song(attribute)
-            previous = last_song(attribute)
-            prepre = prelast_song(attribute)
+class RepeaterRater(Rater):
+    """Rate songs down that repeat attributes of the songs picked last.
 
-            if this != previous:
-                repetitions = 0
-            else:
-                # We're repeating
-                if previous == prepre:
-                    repetitions = 2
-                else:
-                    repetitions = 1
+    For each RepetitionRule, songs repeating the attribute more often than allowed within
+    the window get a score of 0, songs repeating it exactly as often as allowed get the
+    rule's weight and all others half of it. The scores of the rules are added up. The
+    first pick gets max_score, as there's nothing to repeat yet.
 
-            if repetitions > allowed_repetitions:
+    The attributes in the window are counted once per pick, so all songs with the same
+    attribute are rated the same without looking at the playlist again."""
+    name = "Repeater"
+    context_dependent = True
+
+    # genre may be repeated twice in a row, artist never
+    rules = (RepetitionRule('genre', 2, 2, 1.), RepetitionRule('artist', 1, 0, 0.))
+
+    def __init__(self, rules=None):
+        if rules is not None:
+            self.rules = tuple(RepetitionRule(*rule) for rule in rules)
+        self.max_score = sum(max(0., rule.weight) for rule in self.rules)
+
+        # features, history, number of picks counted and the counters per rule of the last
+        # history rated; see _counters
+        self.window = None
+
+    def config(self):
+        # The rules may be the ones of the class
+        return "%s%r" % (type(self).__name__, [tuple(rule) for rule in self.rules])
+
+    def _counters(self, features, history):
+        """Per rule, how many of the last window picks have each attribute id. Only the
+        picks added since the last call are counted, as long as the history only grows."""
+        window = self.window
+        if window is None or window[0] is not features or window[1] is not history or window[2] > len(history):
+            window = self.window = [features, history, 0, [collections.Counter() for rule in self.rules]]
+
+        counted = window[2]
+        indices = history.indices
+        for rule, counter in zip(self.rules, window[3]):
+            ids = features.tag(rule.attribute)
+            # counter holds the picks at positions counted-rule.window up to counted
+            if len(indices) - counted >= rule.window:
+                counter.clear()
+                for position in xrange(max(0, len(indices) - rule.window), len(indices)):
+                    counter[ids[indices[position]]] += 1
+                continue
+
+            for position in xrange(counted, len(indices)):
+                counter[ids[indices[position]]] += 1
+                if position >= rule.window:
+                    left = ids[indices[position - rule.window]]
+                    counter[left] -= 1
+                    if not counter[left]:
+                        del counter[left]
+        window[2] = len(indices)
+        return window[3]
+
+    def reach(self, features, indices, position):
+        return min(len(indices) - 1, position + max(rule.window for rule in self.rules))
+
+    def rate_index(self, features, index, history):
+        if not history:
+            # Nothing to repeat yet
+            return self.max_score
+
+        total_rating = 0.
+        for rule, counter in zip(self.rules, self._counters(features, history)):
+            repetitions = counter[features.tag(rule.attribute)[index]]
+
+            if repetitions > rule.allowed:
                 # We'd be repeating more than we should =(
                 return 0. # Force 0
-            elif repetitions == allowed_repetitions:
+            elif repetitions == rule.allowed:
                 # We're on point with repetitions. This is good
-                total_rating += weight
+                total_rating += rule.weight
             else:
                 # We're repeating less than we're allowed. This is ok but not good
-                total_rating += weight/2
+                total_rating += rule.weight/2
 
         return total_rating
 
+    def rate_batch(self, features, indices, history):
+        if not history:
+            return numpy.ones(len(indices)) * self.max_score
+
+        total_rating = numpy.zeros(len(indices))
+        forced_zero = numpy.zeros(len(indices), dtype=bool)
+
+        for rule, counter in zip(self.rules, self._counters(features, history)):
+            ids = features.vector(rule.attribute)[indices]
+
+            # Same rules as in rate_index, once per attribute id; only the ids in the window
+            # differ from songs that aren't repeating anything
+            id_count = len(features.tag_values[rule.attribute])
+            scores = numpy.empty(id_count)
+            scores.fill(rule.weight if rule.allowed == 0 else rule.weight/2.)
+            forced = numpy.zeros(id_count, dtype=bool)
+            for id, repetitions in counter.iteritems():
+                forced[id] = repetitions > rule.allowed
+                scores[id] = rule.weight if repetitions == rule.allowed else rule.weight/2.
+
+            forced_zero |= forced[ids]
+            total_rating += scores[ids]
+
+        total_rating[forced_zero] = 0.
+        return total_rating
+
+def elementwise(op, a, b):
+    """Apply op to each pair of elements of two score columns; returns a column of the same kind"""
+    if numpy is not None:
+        return op(a, b)
+    return array('d', map(op, a, b))
+
+def _compiled(rater):
+    """Function rating a single song with rater, see AveragedRater.compile"""
+    if isinstance(rater, AveragedRater):
+        return rater.compile()
+    return rater.rate_index
+
+def _untimed(rater):
+    return rater.rater if isinstance(rater, TimedRater) else rater
+
+class StaticScores(object):
+    """Scores of the raters that don't depend on the playlist, for all songs of a snapshot.
+
+    base and modifier hold the combined static part of each song's rating, details the
+    weighted score of each static component by rater."""
+
+    def __init__(self, size):
+        if numpy is not None:
+            self.base = numpy.zeros(size)
+            self.modifier = numpy.ones(size)
+        else:
+            self.base = array('d', [0.]) * size
+            self.modifier = array('d', [1.]) * size
+        self.details = {"base": {}, "modifier": {}}
+
 class AveragedRater(Rater):
     """Combine multiple raters into one. The score is a weighted sum of the components."""
     name = "Averaged"
@@ -100,22 +484,178 @@ class AveragedRater(Rater):
     def __init__(self):
         self.raters = []
 
+    @property
+    def context_dependent(self):
+        return any(rater.context_dependent for _, rater in self.raters)
+
+    @property
+    def max_score(self):
+        return max(0., sum(max(0., weight) * rater.max_score for weight, rater in self.raters))
+
     def add_rater(self, weight, rater):
         self.raters.append((weight, rater))
 
-    def rate_with_details(self, song, song_list):
+    def config(self):
+        return "%s%r" % (type(self).__name__, [(weight, rater.config()) for weight, rater in self.raters])
+
+    def static_components(self):
+        """The components rated by rate_static, as (kind, weight, rater) in the order they are
+        kept in StaticScores.details"""
+        return [("base", weight, rater) for weight, rater in self.raters if not rater.context_dependent]
+
+    def instrument(self, stats):
+        """Record the calls of all components in stats (a RaterStats) until uninstrument is called"""
+        self.raters = [(weight, TimedRater(rater, stats)) for weight, rater in self.raters]
+
+    def uninstrument(self):
+        self.raters = [(weight, _untimed(rater)) for weight, rater in self.raters]
+
+    def close(self):
+        for _, rater in self.raters:
+            rater.close()
+
+    @staticmethod
+    def _rate_column(features, weight, rater):
+        history = History(features)
+        if numpy is not None:
+            return weight * rater.rate_batch(features, numpy.arange(len(features)), history)
+        return array('d', (weight * rater.rate_index(features, i, history) for i in xrange(len(features))))
+
+    def rate_static(self, features):
+        """Rate all songs of the snapshot with the components that don't depend on the playlist.
+        The result can be passed to rate_index to only evaluate the remaining components."""
+        static = StaticScores(len(features))
+        for weight, rater in self.raters:
+            if not rater.context_dependent:
+                column = self._rate_column(features, weight, rater)
+                static.details["base"][rater] = column
+                static.base = elementwise(operator.add, static.base, column)
+
+        return static
+
+    def rate_index(self, features, index, history, static=None):
+        score = 0.
+        if static is not None:
+            score = static.base[index]
+
+        for weight, rater in self.raters:
+            if static is not None and not rater.context_dependent:
+                continue # already rated in static
+            score += weight * rater.rate_index(features, index, history)
+
+        return max(0, score)
+
+    def compile(self, static=None):
+        """Fuse the rater tree into a single function rate(features, index, history) that
+        returns the same as rate_index(features, index, history, static).
+
+        Weights are resolved now and components with weight 0 are left out, so compile
+        again after changing the tree."""
+        namespace = {"max": max}
+        lines = self._compile_lines(static, namespace) + ["return score"]
+        source = "def rate(features, index, history):\n" + "".join("    %s\n" % line for line in lines)
+        exec source in namespace
+        return namespace["rate"]
+
+    def _compile_lines(self, static, namespace):
+        """Source lines computing score for compile; constants are put into namespace"""
+        if static is not None:
+            namespace["base"] = static.base
+            lines = ["score = base[index]"]
+        else:
+            lines = ["score = 0."]
+
+        for i, (weight, rater) in enumerate(self.raters):
+            if weight == 0 or (static is not None and not rater.context_dependent):
+                continue # adds nothing or already rated in static
+            namespace["rater%i" % i] = _compiled(rater)
+            lines.append("score += %r * rater%i(features, index, history)" % (weight, i))
+
+        lines.append("score = max(0, score)")
+        return lines
+
+    def explain(self, features, index, history, static=None):
+        """Like rate_index, but also return the breakdown of the score:
+        {"base": {rater: weighted score}, "modifier": {rater: weighted score}}"""
         score = 0.
         rating_details = {}
+        if static is not None:
+            score = static.base[index]
+            for rater, column in static.details["base"].iteritems():
+                rating_details[rater] = column[index]
+
         for weight, rater in self.raters:
-            this_score = weight * rater.rate(song, song_list)
+            if static is not None and not rater.context_dependent:
+                continue # already rated in static
+            this_score = weight * rater.rate_index(features, index, history)
             rating_details[rater] = this_score
             score += this_score
 
-        return max(0, score), rating_details
+        return max(0, score), {"base": rating_details, "modifier": {}}
 
-    def rate(self, song, song_list):
-        score, _ = self.rate_with_details(song, song_list)
-        return score
+    def support(self, features, history):
+        # A sum can only be above 0 if one of its components is
+        if any(weight > 0 and not rater.context_dependent for weight, rater in self.raters):
+            return None
+
+        songs = set()
+        for weight, rater in self.raters:
+            if weight > 0:
+                rater_support = rater.support(features, history)
+                if rater_support is None:
+                    return None
+                songs.update(rater_support)
+        return songs
+
+    def reach(self, features, indices, position):
+        return max([position] + [rater.reach(features, indices, position)
+                                 for weight, rater in self.raters if weight != 0])
+
+    def rate_with_details(self, song, song_list):
+        """Rate song after song_list; returns the score and the weighted scores of the
+        components by rater (see explain)"""
+        features, history = SongFeatures.for_playlist(song, song_list)
+        score, details = self.explain(features, len(features) - 1, history)
+        return score, details["base"]
+
+    def rate_batch(self, features, indices, history, static=None):
+        if static is not None:
+            score = static.base[indices]
+        else:
+            score = numpy.zeros(len(indices))
+
+        for weight, rater in self.raters:
+            if static is not None and not rater.context_dependent:
+                continue # already rated in static
+            score += weight * rater.rate_batch(features, indices, history)
+
+        return numpy.maximum(score, 0.)
+
+    def upper_bound(self, static, index):
+        """Highest score rate_index can return for song number index with the given
+        static scores, whatever the playlist is"""
+        score = static.base[index]
+        for weight, rater in self.raters:
+            if rater.context_dependent:
+                score += max(0., weight) * rater.max_score
+
+        return max(0., score)
+
+    def upper_bounds(self, static):
+        """upper_bound of all songs, as a column"""
+        # Added one by one like upper_bound does, for the same rounding
+        context = [max(0., weight) * rater.max_score for weight, rater in self.raters
+                   if rater.context_dependent]
+        if numpy is not None:
+            scores = static.base.copy()
+            for score in context:
+                scores += score
+            return numpy.maximum(scores, 0.)
+        scores = static.base
+        for score in context[:-1]:
+            scores = [value + score for value in scores]
+        last = context[-1] if context else 0.
+        return array('d', (max(0., value + last) for value in scores))
 
 class ModifiedAveragedRater(AveragedRater):
     """Combine an averaged rater with modificators; Base raters are a weighted sum, modifiers multiply the score after"""
@@ -126,105 +666,1867 @@ class ModifiedAveragedRater(AveragedRater):
         self.modifiers = []
         self.last_rating = {"base":{}, "modifier": {}}
 
+    @property
+    def context_dependent(self):
+        return (super(ModifiedAveragedRater, self).context_dependent or
+                any(modifier.context_dependent for _, modifier in self.modifiers))
+
+    @property
+    def max_score(self):
+        score = super(ModifiedAveragedRater, self).max_score
+        for weight, modifier in self.modifiers:
+            score *= max(0., weight) * modifier.max_score
+        return score
+
     def add_modifier(self, weight, rater):
         self.modifiers.append((weight, rater))
 
-    def rate_with_details(self, song, song_list):
-        score, rating_details = super(ModifiedAveragedRater, self).rate_with_details(song, song_list)
+    def config(self):
+        return "%s*%r" % (super(ModifiedAveragedRater, self).config(),
+                          [(weight, modifier.config()) for weight, modifier in self.modifiers])
+
+    def static_components(self):
+        return (super(ModifiedAveragedRater, self).static_components() +
+                [("modifier", weight, modifier) for weight, modifier in self.modifiers
+                 if not modifier.context_dependent])
+
+    def instrument(self, stats):
+        super(ModifiedAveragedRater, self).instrument(stats)
+        self.modifiers = [(weight, TimedRater(modifier, stats)) for weight, modifier in self.modifiers]
+
+    def uninstrument(self):
+        super(ModifiedAveragedRater, self).uninstrument()
+        self.modifiers = [(weight, _untimed(modifier)) for weight, modifier in self.modifiers]
+
+    def close(self):
+        super(ModifiedAveragedRater, self).close()
+        for _, modifier in self.modifiers:
+            modifier.close()
+
+    def rate_static(self, features):
+        static = super(ModifiedAveragedRater, self).rate_static(features)
+
+        for weight, modifier in self.modifiers:
+            if not modifier.context_dependent:
+                column = self._rate_column(features, weight, modifier)
+                static.details["modifier"][modifier] = column
+                static.modifier = elementwise(operator.mul, static.modifier, column)
+
+        return static
+
+    def rate_index(self, features, index, history, static=None):
+        score = super(ModifiedAveragedRater, self).rate_index(features, index, history, static)
+
+        if static is not None:
+            score *= static.modifier[index]
+
+        for weight, modifier in self.modifiers:
+            if static is not None and not modifier.context_dependent:
+                continue # already rated in static
+            score *= weight * modifier.rate_index(features, index, history)
+
+        return score
+
+    def _compile_lines(self, static, namespace):
+        lines = super(ModifiedAveragedRater, self)._compile_lines(static, namespace)
+
+        if static is not None:
+            namespace["modifier"] = static.modifier
+            lines.append("score *= modifier[index]")
+
+        for i, (weight, modifier) in enumerate(self.modifiers):
+            if static is not None and not modifier.context_dependent:
+                continue # already rated in static
+            if weight == 0:
+                return ["score = 0."]
+            namespace["modifier%i" % i] = _compiled(modifier)
+            lines.append("score *= %r * modifier%i(features, index, history)" % (weight, i))
+
+        return lines
+
+    def explain(self, features, index, history, static=None):
+        score, details = super(ModifiedAveragedRater, self).explain(features, index, history, static)
 
-        # save rating details for later use
-        # Newly initialize! Otherwise we share information between rating runs
-        self.last_rating = { "base":{}, "modifier":{} }
-        self.last_rating["base"] = rating_details
+        if static is not None:
+            score *= static.modifier[index]
+            for modifier, column in static.details["modifier"].iteritems():
+                details["modifier"][modifier] = column[index]
 
         for weight, modifier in self.modifiers:
-            this_score = weight * modifier.rate(song, song_list)
-            self.last_rating["modifier"][modifier] = this_score # save for later use
+            if static is not None and not modifier.context_dependent:
+                continue # already rated in static
+            this_score = weight * modifier.rate_index(features, index, history)
+            details["modifier"][modifier] = this_score
             score *= this_score
 
+        return score, details
+
+    def rate_with_details(self, song, song_list):
+        features, history = SongFeatures.for_playlist(song, song_list)
+        # save rating details for later use, see rating_details
+        score, self.last_rating = self.explain(features, len(features) - 1, history)
         return score
 
+    def rate_batch(self, features, indices, history, static=None):
+        score = super(ModifiedAveragedRater, self).rate_batch(features, indices, history, static)
+
+        if static is not None:
+            score *= static.modifier[indices]
+
+        for weight, modifier in self.modifiers:
+            if static is not None and not modifier.context_dependent:
+                continue # already rated in static
+            score *= weight * modifier.rate_batch(features, indices, history)
+
+        return score
+
+    def upper_bound(self, static, index):
+        score = super(ModifiedAveragedRater, self).upper_bound(static, index) * static.modifier[index]
+        for weight, modifier in self.modifiers:
+            if modifier.context_dependent:
+                score *= max(0., weight) * modifier.max_score
+
+        return max(0., score)
+
+    def upper_bounds(self, static):
+        context = [max(0., weight) * modifier.max_score for weight, modifier in self.modifiers
+                   if modifier.context_dependent]
+        bounds = super(ModifiedAveragedRater, self).upper_bounds(static)
+        if numpy is not None:
+            scores = bounds * static.modifier
+            for score in context:
+                scores *= score
+            return numpy.maximum(scores, 0.)
+        scores = [bound * modifier for bound, modifier in zip(bounds, static.modifier)]
+        for score in context[:-1]:
+            scores = [value * score for value in scores]
+        last = context[-1] if context else 1.
+        return array('d', (max(0., value * last) for value in scores))
+
+    def support(self, features, history):
+        # A product is 0 as soon as one modifier is
+        songs = None
+        for weight, modifier in self.modifiers:
+            modifier_support = modifier.support(features, history)
+            if modifier_support is not None:
+                songs = set(modifier_support) if songs is None else songs.intersection(modifier_support)
+
+        base_support = super(ModifiedAveragedRater, self).support(features, history)
+        if base_support is not None:
+            songs = base_support if songs is None else songs.intersection(base_support)
+        return songs
+
+    def reach(self, features, indices, position):
+        return max([super(ModifiedAveragedRater, self).reach(features, indices, position)] +
+                   [modifier.reach(features, indices, position) for _, modifier in self.modifiers])
+
     def rating_details(self):
         return self.last_rating
 
-class RatedLibrary():
-    def __init__(self, library, rater):
-        self.library = library
+class WrappedRater(Rater):
+    """Base for raters that rate with another rater and add something on top"""
+
+    def __init__(self, rater):
         self.rater = rater
 
-    def __getitem__(self, index):
-        return self.library[index]
+    @property
+    def name(self):
+        return self.rater.name
+
+    @property
+    def context_dependent(self):
+        return self.rater.context_dependent
+
+    @property
+    def max_score(self):
+        return self.rater.max_score
+
+    def rate_index(self, features, index, history):
+        return self.rater.rate_index(features, index, history)
+
+    def rate_batch(self, features, indices, history):
+        return self.rater.rate_batch(features, indices, history)
+
+    def support(self, features, history):
+        return self.rater.support(features, history)
+
+    def reach(self, features, indices, position):
+        return self.rater.reach(features, indices, position)
+
+    def close(self):
+        self.rater.close()
+
+    def config(self):
+        return self.rater.config()
 
-    def __iter__(self):
-        return iter(self.library)
+# State of a ParallelRater worker process; set up by _init_rating_worker
+_worker_state = {}
 
-    def create_playlist(self, init_playlist=[], num_items=None, play_length=None, debug=False):
-        playlist = []
-        total_play_length = 0.
+def _init_rating_worker(rater, features):
+    _worker_state["rater"] = rater
+    _worker_state["features"] = features
 
-        # if we need to create a playlist with a specific duration, we need to know how long the
-        # initial playlist takes
-        for song in init_playlist:
-            total_play_length += song("~#length")
+def _rate_chunk(args):
+    indices, history_indices = args
+    features = _worker_state["features"]
+    return _worker_state["rater"].rate_batch(features, indices, History(features, history_indices))
 
-        if debug:
-            print "Total length in Queue: %i, goal: %i" % (total_play_length, play_length)
+# State of a RatedLibrary.create_playlists worker process; set up by _init_batch_worker
+_batch_state = {}
 
-        songs = self.library[:] # make a copy of the song list
+def _init_batch_worker(features, specs, statics, sampling, init_playlist):
+    _batch_state.update(features=features, specs=specs, statics=statics, sampling=sampling,
+                        init_playlist=init_playlist)
 
-        # remove the songs already in the initial playlist
-        for song in init_playlist:
-            try:
-                songs.remove(song)
-            except ValueError:
-                pass
+def _create_batch_playlist(number):
+    """Pick the playlist of spec number; returns the indices of the songs"""
+    features = _batch_state["features"]
+    spec = _batch_state["specs"][number]
+
+    session = PlaylistSession(_batch_state["init_playlist"], _batch_state["sampling"],
+                              rng=random.Random(spec.seed), tolerance=spec.tolerance)
+    session.features = features
+    session.static = _batch_state["statics"][number]
+    play_length = spec.play_length
+    if play_length is not None:
+        play_length -= session.queue_length
+    for song in RatedLibrary(features.songs, spec.rater)._extend_new(session, spec.num_items, play_length):
+        pass
+    if spec.budget is None or not session.playlist:
+        return session.playlist.indices
+
+    optimizer = PlaylistOptimizer.for_session(spec.rater, session, play_length)
+    optimizer.run(spec.budget)
+    return optimizer.indices
+
+class ParallelRater(WrappedRater):
+    """Rate songs with the wrapped rater in a pool of worker processes.
+
+    Only worth it for expensive raters: each batch of candidates is split into chunks
+    that are rated in the workers, so every call pays for the IPC. The scores are the
+    same as those of the wrapped rater, whatever the number of processes, as long as
+    the wrapped rater is deterministic. Batches need numpy (see rate_batch); single
+    songs and small batches are rated in this process.
+
+    The workers keep a copy of the snapshot; they are stopped by close, which
+    RatedLibrary.extend calls once it is done."""
+
+    # Batches smaller than this are rated in this process
+    min_batch = 256
+
+    def __init__(self, rater, processes=None):
+        super(ParallelRater, self).__init__(rater)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = None
+        self.pool_features = None
+
+    def rate_batch(self, features, indices, history):
+        if len(indices) < self.min_batch or self.processes < 2:
+            return self.rater.rate_batch(features, indices, history)
+
+        # The workers keep the snapshot; start new ones when it changes
+        if self.pool_features is not features:
+            self.close()
+            self.pool = multiprocessing.Pool(self.processes, _init_rating_worker, (self.rater, features))
+            self.pool_features = features
+
+        chunks = numpy.array_split(indices, self.processes * 4)
+        scores = self.pool.map(_rate_chunk, [(chunk, history.indices) for chunk in chunks])
+        return numpy.concatenate(scores)
+
+    def close(self):
+        """Stop the worker processes"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            self.pool_features = None
+        super(ParallelRater, self).close()
 
-        while (len(songs) > 0 and       # as long as there's still songs to choose from
-               (num_items is None or len(playlist) <= num_items) and        # and the total duration is not reached
-               (play_length is None or total_play_length < play_length)):       # and we have not found enough songs
-            scores = {}
-            rating_details = {}
+class _Phase(object):
+    """Context manager adding the time spent in its block to a phase of RaterStats"""
+    __slots__ = ("stats", "name", "start")
 
-            total_score = 0.
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
 
-            # Rate all songs depending on the current playlist
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.stats.add_phase(self.name, time.time() - self.start)
+
+class _NoPhase(object):
+    """Stand-in for _Phase when nothing is recorded"""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_PHASE = _NoPhase()
+
+class RaterStats(object):
+    """Profile of playlist runs; pass it to RatedLibrary to enable it.
+
+    calls holds the number of songs rated per rater (by name), latencies the duration of
+    every call (a batch is one call) and phases the time spent per part of iter_playlist."""
+
+    def __init__(self):
+        self.calls = {}
+        self.latencies = {}
+        self.phases = {}
+
+    def record(self, name, seconds, songs=1):
+        try:
+            self.calls[name] += songs
+        except KeyError:
+            self.calls[name] = songs
+            self.latencies[name] = array('d')
+        self.latencies[name].append(seconds)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.) + seconds
+
+    def phase(self, name):
+        """Context manager timing its block as the given phase"""
+        return _Phase(self, name)
+
+    def total(self, name):
+        """Seconds spent in the given rater"""
+        return sum(self.latencies[name])
+
+    def percentile(self, name, percent):
+        """Latency of the given rater's calls at percent (0-100)"""
+        latencies = sorted(self.latencies[name])
+        return latencies[int(round((len(latencies) - 1) * percent / 100.))]
+
+    def summary(self):
+        lines = []
+        for name, seconds in sorted(self.phases.items()):
+            lines.append("%-12s %8.3fs" % (name, seconds))
+
+        for name in sorted(self.calls):
+            lines.append("%-12s %8.3fs %9i songs %8i calls   p50 %.1fus  p90 %.1fus  p99 %.1fus" % (
+                name, self.total(name), self.calls[name], len(self.latencies[name]),
+                self.percentile(name, 50) * 1e6, self.percentile(name, 90) * 1e6, self.percentile(name, 99) * 1e6))
+
+        return "\n".join(lines)
+
+class TimedRater(WrappedRater):
+    """Record the calls of the wrapped rater in a RaterStats; see AveragedRater.instrument"""
+
+    def __init__(self, rater, stats):
+        super(TimedRater, self).__init__(rater)
+        self.stats = stats
+
+    def rate_index(self, features, index, history):
+        start = time.time()
+        score = self.rater.rate_index(features, index, history)
+        self.stats.record(self.rater.name, time.time() - start)
+        return score
+
+    def rate_batch(self, features, indices, history):
+        start = time.time()
+        scores = self.rater.rate_batch(features, indices, history)
+        self.stats.record(self.rater.name, time.time() - start, len(indices))
+        return scores
+
+class TraceRecorder(object):
+    """Explanations of the last picked songs, see RatedLibrary.
+
+    Only the picked songs are explained, and only the last `size` of them are kept."""
+
+    def __init__(self, size=1000):
+        self.traces = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.traces)
+
+    def __iter__(self):
+        return iter(self.traces)
+
+    def record(self, position, song, score, details):
+        """Remember why song was picked at position (counted from the first picked song)"""
+        self.traces.append((position, song, score,
+                            tuple((rater.name, value) for rater, value in details["base"].iteritems()),
+                            tuple((rater.name, value) for rater, value in details["modifier"].iteritems())))
+
+    def export(self, fileobj):
+        """Write the explanations to fileobj, one JSON object per line"""
+        for position, song, score, base, modifier in self.traces:
+            filename = song("~filename")
+            if not isinstance(filename, unicode):
+                # File names are bytes in any encoding on most systems; this is only for reading
+                filename = filename.decode("utf-8", "replace")
+            fileobj.write(json.dumps({
+                "position": position,
+                "title": song("title"),
+                "filename": filename,
+                "score": float(score),
+                "base": dict((name, float(value)) for name, value in base),
+                "modifier": dict((name, float(value)) for name, value in modifier),
+            }) + "\n")
+
+class FeatureIndex(object):
+    """SongFeatures columns and static scores of a library, kept in a file across runs.
+
+    Songs are keyed by file path; their features are reused as long as mtime and rating
+    didn't change (tags changed without touching the file, e.g. by the BPM Tagger, are
+    reported by the library, see watch), their static scores as long as the static part of the rater tree is
+    configured the same (see Rater.config). With numpy, the file is memory mapped and
+    its columns are only copied once something changes.
+
+    File layout: MAGIC, the length of the JSON header, the header, then the columns, each
+    starting at a multiple of 8 bytes, then the paths separated by NUL bytes (unicode paths
+    UTF-8 encoded, their rows listed in the header)."""
+
+    MAGIC = "WPLIDX\n"
+    VERSION = 3
+
+    # name, typecode of the feature columns; the tags are interned
+    feature_columns = (("mtime", 'd'), ("rating", 'd'), ("bpm", 'd'), ("length", 'd'))
+    tags = SongFeatures.preloaded_tags
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.clear()
+        self.load()
+
+        # Changes reported by the library since the last snapshot: path -> song, or None if
+        # removed. Kept apart so the library signals never wait for a running snapshot.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.handlers = []
+        # Whether a flush of the pending changes is waiting for its callback (see watch)
+        self.flush_deferred = False
+
+    def __len__(self):
+        return len(self.rows)
+
+    def clear(self):
+        # paths by row; None for rows of removed songs until the index is saved
+        self.paths = []
+        self.rows = {}
+        self.columns = dict((name, array(typecode)) for name, typecode in self.feature_columns)
+        for tag in self.tags:
+            self.columns[tag] = array('i')
+        self.tag_values = dict((tag, []) for tag in self.tags)
+        self.tag_ids = dict((tag, {}) for tag in self.tags)
+
+        # static scores: rater configuration, column name -> column; NaN if not rated yet
+        self.config = None
+        self.static = {}
+
+        self.mapped = None
+        self.dirty = False
+
+    def load(self):
+        try:
+            fileobj = open(self.path, "rb")
+        except IOError:
+            return
+
+        with fileobj:
+            try:
+                if fileobj.read(len(self.MAGIC)) != self.MAGIC:
+                    raise ValueError("not an index file")
+                header_length, = struct.unpack("<Q", fileobj.read(8))
+                header = json.loads(fileobj.read(header_length))
+                if header["version"] != self.VERSION or header["byteorder"] != sys.byteorder:
+                    raise ValueError("incompatible index file")
+                data_start = _aligned(len(self.MAGIC) + 8 + header_length)
+
+                if numpy is not None:
+                    self.mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+                columns = {}
+                for name, typecode, offset in header["columns"]:
+                    columns[name] = self._read_column(fileobj, typecode, data_start + offset, header["count"])
+
+                offset, length = header["paths"]
+                fileobj.seek(data_start + offset)
+                paths = fileobj.read(length).split("\0") if header["count"] else []
+                if len(paths) != header["count"]:
+                    raise ValueError("truncated index file")
+                for row in header["unicode_paths"]:
+                    paths[row] = paths[row].decode("utf-8")
+            except (ValueError, KeyError, struct.error, EnvironmentError), e:
+                print "Ignoring feature index %s: %s" % (self.path, e)
+                self.clear()
+                return
+
+        self.paths = paths
+        self.rows = dict((path, row) for row, path in enumerate(self.paths))
+        self.tag_values = header["tag_values"]
+        self.tag_ids = dict((tag, dict((value, i) for i, value in enumerate(values)))
+                            for tag, values in self.tag_values.iteritems())
+        self.config = header["config"]
+        self.static = dict((name, column) for name, column in columns.iteritems() if name.startswith("static:"))
+        for name, column in columns.iteritems():
+            if not name.startswith("static:"):
+                self.columns[name] = column
+
+    def _read_column(self, fileobj, typecode, offset, count):
+        if self.mapped is not None:
+            dtype = numpy.float64 if typecode == 'd' else numpy.intc
+            return numpy.frombuffer(self.mapped, dtype=dtype, count=count, offset=offset)
+
+        column = array(typecode)
+        fileobj.seek(offset)
+        column.fromfile(fileobj, count)
+        return column
+
+    def save(self):
+        """Write the index to its file if it changed"""
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self.dirty:
+            return
+
+        if len(self.rows) < len(self.paths):
+            self._compact()
+
+        columns = [(name, self.columns[name]) for name, _ in self.feature_columns]
+        columns += [(tag, self.columns[tag]) for tag in self.tags]
+        columns += sorted(self.static.items())
+
+        header_columns = []
+        offset = 0
+        for name, column in columns:
+            typecode = 'i' if name in self.tags else 'd'
+            header_columns.append((name, typecode, offset))
+            offset = _aligned(offset + len(column) * array(typecode).itemsize)
+
+        # Quod Libet's file names are bytes in any encoding on most systems, unicode on Windows
+        unicode_paths = [row for row, path in enumerate(self.paths) if isinstance(path, unicode)]
+        paths = "\0".join(path.encode("utf-8") if isinstance(path, unicode) else path for path in self.paths)
+
+        header = json.dumps({
+            "version": self.VERSION,
+            "byteorder": sys.byteorder,
+            "count": len(self.paths),
+            "paths": (offset, len(paths)),
+            "unicode_paths": unicode_paths,
+            "tag_values": self.tag_values,
+            "config": self.config,
+            "columns": header_columns,
+        })
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as fileobj:
+            fileobj.write(self.MAGIC)
+            fileobj.write(struct.pack("<Q", len(header)))
+            fileobj.write(header)
+            data_start = _aligned(fileobj.tell())
+            for (name, column), (_, _, column_offset) in zip(columns, header_columns):
+                fileobj.seek(data_start + column_offset)
+                fileobj.write(column.tostring() if isinstance(column, array) else column.tobytes())
+            fileobj.seek(data_start + offset)
+            fileobj.write(paths)
+
+        try:
+            os.rename(temp_path, self.path)
+        except OSError:
+            # Windows doesn't replace existing files
+            os.remove(self.path)
+            os.rename(temp_path, self.path)
+        self.dirty = False
+
+    def _compact(self):
+        """Drop the rows of removed songs"""
+        self._writable()
+        kept = [row for row, path in enumerate(self.paths) if path is not None]
+        for columns in (self.columns, self.static):
+            for name, column in columns.items():
+                columns[name] = _take(column, kept)
+        self.paths = [self.paths[row] for row in kept]
+        self.rows = dict((path, row) for row, path in enumerate(self.paths))
+
+    def watch(self, library, defer=None):
+        """Keep the index up to date with the songs of a Quod Libet library.
+
+        Changes are applied on the next snapshot. With defer (e.g. a GLib timeout), they are
+        also applied and saved once defer calls back, so changes not touching the files
+        survive a restart even without another snapshot; defer(callback) may call back
+        again as long as callback returns True."""
+        def changed(library, songs):
+            self.changed(songs)
+            self._defer_flush(defer)
+
+        def removed(library, songs):
+            self.removed(songs)
+            self._defer_flush(defer)
+
+        self.handlers = [
+            (library, library.connect("added", changed)),
+            (library, library.connect("changed", changed)),
+            (library, library.connect("removed", removed)),
+        ]
+
+    def _defer_flush(self, defer):
+        if defer is not None and not self.flush_deferred:
+            self.flush_deferred = True
+            defer(self.flush)
+
+    def flush(self):
+        """Apply and save the pending changes; returns True if a snapshot is running, so
+        this should be tried again later"""
+        if not self.lock.acquire(False):
+            return True
+        try:
+            self.flush_deferred = False
+            self._apply_pending()
+            self._save()
+        finally:
+            self.lock.release()
+        return False
+
+    def unwatch(self):
+        for library, handler in self.handlers:
+            library.disconnect(handler)
+        self.handlers = []
+
+    def changed(self, songs):
+        """Note that songs were added or their tags changed; they are updated on the next snapshot"""
+        with self.pending_lock:
             for song in songs:
-                scores[song] = self.rater.rate_with_details(song, playlist)
-                if debug:
-                    rating_details[song] = self.rater.rating_details()
-                total_score += scores[song]
+                self.pending[song("~filename")] = song
 
-            random_score = random.random() * total_score
-            current_score = 0.
+    def removed(self, songs):
+        """Note that songs were removed from the library"""
+        with self.pending_lock:
+            for song in songs:
+                self.pending[song("~filename")] = None
+
+    def _apply_pending(self):
+        """Update the rows of all songs reported as changed since the last snapshot"""
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        changed = [song for song in pending.itervalues() if song is not None]
+        if changed:
+            self._store(SongFeatures(changed))
+        for path, song in pending.iteritems():
+            if song is None and path in self.rows:
+                self.paths[self.rows.pop(path)] = None
+                self.dirty = True
+
+    def snapshot(self, songs, rater):
+        """Return SongFeatures and StaticScores (see AveragedRater.rate_static) of songs,
+        computing only what isn't in the index yet"""
+        with self.lock:
+            self._apply_pending()
+            songs = list(songs)
+
+            config = repr([(kind, weight, component.config())
+                           for kind, weight, component in rater.static_components()])
+            if config != self.config:
+                self._writable()
+                self.config = config
+                self.static = {}
+                self.dirty = True
+
+            rows = []
+            changed = []
+            mtimes = self.columns["mtime"]
+            ratings = self.columns["rating"]
+            for song in songs:
+                row = self.rows.get(song("~filename"))
+                if row is None or mtimes[row] != song("~#mtime") or ratings[row] != song("~#rating"):
+                    changed.append(song)
+                rows.append(row)
+
+            if changed:
+                self._store(SongFeatures(changed))
+                rows = [self.rows[song("~filename")] for song in songs]
+            if numpy is not None:
+                # Converted once for all the columns taken
+                rows = numpy.array(rows, dtype=numpy.intp)
+
+            features = self._gather(songs, rows)
+            static = self._static_scores(features, rows, rater)
+            return features, static
+
+    def _writable(self):
+        """Replace memory mapped columns by arrays that can be changed"""
+        if self.mapped is None:
+            return
+
+        for columns in (self.columns, self.static):
+            for name, column in columns.items():
+                typecode = 'd' if column.dtype == numpy.float64 else 'i'
+                columns[name] = array(typecode, column.tostring())
+        self.mapped = None
+
+    def _store(self, features):
+        """Add or update the rows of all songs of features"""
+        self._writable()
+        self.dirty = True
+        for i, song in enumerate(features.songs):
+            path = song("~filename")
+            values = [("mtime", song("~#mtime")), ("rating", features.rating[i]),
+                      ("bpm", features.bpm[i]), ("length", features.length[i])]
+            values += [(tag, self._intern(tag, features.tag_values[tag][features.tags[tag][i]]))
+                       for tag in self.tags]
+
+            row = self.rows.get(path)
+            if row is None:
+                row = self.rows[path] = len(self.paths)
+                self.paths.append(path)
+                for name, value in values:
+                    self.columns[name].append(value)
+                for column in self.static.itervalues():
+                    column.append(NAN)
+            else:
+                for name, value in values:
+                    self.columns[name][row] = value
+                for column in self.static.itervalues():
+                    column[row] = NAN
 
-            for song, score in scores.items():
-                current_score += score
-                if current_score >= random_score:
-                    break
+    def _intern(self, tag, value):
+        ids = self.tag_ids[tag]
+        try:
+            return ids[value]
+        except KeyError:
+            ids[value] = len(ids)
+            self.tag_values[tag].append(value)
+            return ids[value]
+
+    def _gather(self, songs, rows):
+        columns = dict((name, _take(self.columns[name], rows)) for name in self.columns)
+        tags = dict((tag, columns[tag]) for tag in self.tags)
+        tag_values = dict((tag, list(self.tag_values[tag])) for tag in self.tags)
+        return SongFeatures.from_columns(songs, columns["bpm"], columns["rating"], columns["length"],
+                                         tags, tag_values)
+
+    def _static_scores(self, features, rows, rater):
+        components = rater.static_components()
+        names = ["static:base", "static:modifier"] + ["static:%s%i" % (kind, i) for i, (kind, _, _) in enumerate(components)]
+
+        if not self.static:
+            self.static = dict((name, array('d', [NAN]) * len(self.paths)) for name in names)
+
+        # Rate the songs the index has no static scores of yet
+        base = self.static["static:base"]
+        if numpy is not None:
+            missing = numpy.flatnonzero(numpy.isnan(_take(base, rows, rows))).tolist()
+        else:
+            missing = [position for position, row in enumerate(rows) if isnan(base[row])]
+        if missing:
+            self._writable()
+            self.dirty = True
+            rated = rater.rate_static(SongFeatures.from_columns(
+                [features.songs[position] for position in missing],
+                _take(features.bpm, missing), _take(features.rating, missing), _take(features.length, missing),
+                dict((tag, _take(features.tags[tag], missing)) for tag in self.tags), features.tag_values))
+
+            columns = [rated.base, rated.modifier] + [rated.details[kind][component] for kind, _, component in components]
+            for name, column in zip(names, columns):
+                stored = self.static[name]
+                for position, value in zip(missing, column):
+                    stored[rows[position]] = value
+
+        static = StaticScores(len(rows))
+        static.base = _take(self.static["static:base"], rows, static.base)
+        static.modifier = _take(self.static["static:modifier"], rows, static.modifier)
+        for name, (kind, _, component) in zip(names[2:], components):
+            static.details[kind][component] = _take(self.static[name], rows, static.base)
+        return static
+
+def _aligned(offset):
+    return (offset + 7) // 8 * 8
+
+def _take(column, rows, like=None):
+    """Elements rows of column, as an array (or numpy array if like is one)"""
+    if numpy is not None and len(rows) > 0:
+        if isinstance(column, array):
+            column = numpy.frombuffer(column, dtype=numpy.float64 if column.typecode == 'd' else numpy.intc)
+        taken = column[numpy.asarray(rows, dtype=numpy.intp)]
+        if isinstance(like, numpy.ndarray):
+            return taken
+        return array('d' if taken.dtype == numpy.float64 else 'i', taken.tostring())
+
+    if isinstance(column, array):
+        typecode = column.typecode
+    else:
+        typecode = 'i' if column.dtype == numpy.intc else 'd'
+    return array(typecode, (column[row] for row in rows))
+
+class WeightedSampler(object):
+    """Draw items with a probability proportional to their weight.
+
+    Backed by a sum tree, so drawing, updating and removing an item are O(log n)
+    regardless of how many items there are or how many were drawn already."""
+
+    def __init__(self, items, weights=None):
+        self.items = list(items)
+        self.position = dict((item, i) for i, item in enumerate(self.items))
+
+        self.size = 1
+        while self.size < len(self.items):
+            self.size *= 2
+
+        # weights[node] is the sum of its children; leaves start at size
+        self.weights = [0.] * (2 * self.size)
+        # same layout counting the remaining items; used when all weights are 0
+        self.counts = [0] * (2 * self.size)
+
+        end = self.size + len(self.items)
+        if weights is not None:
+            self.weights[self.size:end] = [max(0., weight) for weight in weights]
+        self.counts[self.size:end] = [1] * len(self.items)
+
+        # One level at a time, from the parents of the leaves up
+        level = self.size
+        while level > 1:
+            for tree in (self.weights, self.counts):
+                tree[level // 2:level] = [left + right for left, right
+                                          in zip(tree[level:2*level:2], tree[level + 1:2*level:2])]
+            level //= 2
+
+    def __len__(self):
+        return self.counts[1]
+
+    def __contains__(self, item):
+        return item in self.position
+
+    def __iter__(self):
+        """Iterate over the remaining items"""
+        return iter(self.position)
+
+    @property
+    def total(self):
+        return self.weights[1]
+
+    def weight(self, item):
+        return self.weights[self.size + self.position[item]]
+
+    def update(self, item, weight):
+        self._set(self.weights, self.size + self.position[item], max(0., weight))
+
+    def remove(self, item):
+        node = self.size + self.position.pop(item)
+        self._set(self.weights, node, 0.)
+        self._set(self.counts, node, 0)
+
+    def copy(self):
+        """A sampler drawing the same items, that can be changed independently"""
+        sampler = WeightedSampler.__new__(WeightedSampler)
+        sampler.items = self.items
+        sampler.position = dict(self.position)
+        sampler.size = self.size
+        sampler.weights = list(self.weights)
+        sampler.counts = list(self.counts)
+        return sampler
+
+    def count(self, limit=None):
+        """Number of remaining items; with limit, of those among the first limit items"""
+        return self._prefix(self.counts, limit)
+
+    def draw(self, random_value=None, limit=None):
+        """Return a random remaining item without removing it. If all weights are 0, all
+        remaining items are equally likely. With limit, only the first limit items (in the
+        order the sampler was created with) are drawn from."""
+        if random_value is None:
+            random_value = random.random()
+        if limit is None or limit > self.size:
+            limit = self.size
+
+        tree = self.weights
+        total = self._prefix(tree, limit)
+        if total <= 0.:
+            tree = self.counts
+            total = self._prefix(tree, limit)
+            if not total:
+                raise IndexError("draw from empty sampler")
+        target = random_value * total
+
+        node = 1
+        start = 0
+        width = self.size
+        while node < self.size:
+            left = 2 * node
+            width //= 2
+            # Never descend into an empty subtree or past limit, even if rounding says so
+            if target < tree[left] or tree[left + 1] <= 0 or start + width >= limit:
+                node = left
+            else:
+                target -= tree[left]
+                node = left + 1
+                start += width
+
+        return self.items[node - self.size]
+
+    def _prefix(self, tree, limit):
+        """Sum of the first limit leaves of tree"""
+        if limit is None or limit >= self.size:
+            return tree[1]
+
+        total = 0
+        node = 1
+        start = 0
+        width = self.size
+        while limit > start and node < self.size:
+            left = 2 * node
+            width //= 2
+            if limit <= start + width:
+                node = left
+            else:
+                total += tree[left]
+                node = left + 1
+                start += width
+
+        if limit > start:
+            total += tree[node]
+        return total
+
+    @staticmethod
+    def _set(tree, node, value):
+        tree[node] = value
+        node //= 2
+        while node:
+            tree[node] = tree[2*node] + tree[2*node + 1]
+            node //= 2
+
+class CumulativeSampler(object):
+    """Draw items like a WeightedSampler (without update), from the running sum of the
+    weights instead of a sum tree.
+
+    It's much quicker to set up, but every removed item adds to the cost of all later
+    draws, so it only suits a few draws from many items (see PlaylistPreview)."""
+
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.position = dict((item, i) for i, item in enumerate(self.items))
+        self.weights = weights
+        self.cumulative = array('d')
+        append = self.cumulative.append
+        total = 0.
+        for weight in weights:
+            if weight > 0.:
+                total += weight
+            append(total)
+        # Positions of the removed items, in order
+        self.removed = []
+
+    def __len__(self):
+        return len(self.position)
+
+    def __contains__(self, item):
+        return item in self.position
+
+    def __iter__(self):
+        """Iterate over the remaining items"""
+        return iter(self.position)
+
+    @property
+    def total(self):
+        return self._prefix(len(self.items))
+
+    def weight(self, item):
+        return max(0., self.weights[self.position[item]])
+
+    def remove(self, item):
+        bisect.insort(self.removed, self.position.pop(item))
+
+    def count(self, limit=None):
+        """Number of remaining items; with limit, of those among the first limit items"""
+        if limit is None or limit > len(self.items):
+            limit = len(self.items)
+        return limit - bisect.bisect_left(self.removed, limit)
+
+    def draw(self, random_value=None, limit=None):
+        """Return a random remaining item without removing it, see WeightedSampler.draw"""
+        if random_value is None:
+            random_value = random.random()
+        if limit is None or limit > len(self.items):
+            limit = len(self.items)
+
+        total = self._prefix(limit)
+        if total > 0.:
+            # Find the item at target in the running sum without the removed items
+            target = random_value * total
+            find = lambda shift: bisect.bisect_right(self.cumulative, target + shift)
+            weigh = lambda position: max(0., self.weights[position])
+        else:
+            count = self.count(limit)
+            if not count:
+                raise IndexError("draw from empty sampler")
+            target = int(random_value * count)
+            find = lambda shift: target + int(shift)
+            weigh = lambda position: 1.
+
+        shift = 0.
+        skipped = 0
+        position = find(shift)
+        # The removed items up to position move it further
+        while skipped < len(self.removed) and self.removed[skipped] <= position:
+            shift += weigh(self.removed[skipped])
+            skipped += 1
+            position = find(shift)
+
+        # Never past limit or onto a removed item, even if rounding says so
+        position = min(position, limit - 1)
+        while self.items[position] not in self.position:
+            position -= 1
+        return self.items[position]
+
+    def _prefix(self, limit):
+        """Sum of the remaining weights among the first limit items"""
+        if not limit:
+            return 0.
+        return self.cumulative[limit - 1] - sum(max(0., self.weights[position]) for position
+                                                in self.removed[:bisect.bisect_left(self.removed, limit)])
+
+# One playlist of RatedLibrary.create_playlists: the rater tree, the seed of its random
+# generator, when to stop (see RatedLibrary.iter_playlist) and the seconds to improve the
+# picks for (see PlaylistOptimizer)
+PlaylistSpec = collections.namedtuple("PlaylistSpec", "rater seed num_items play_length tolerance budget")
+PlaylistSpec.__new__.__defaults__ = (0, None, None, None, None)
+
+class PlaylistSession(object):
+    """A playlist being generated by RatedLibrary.extend, to continue where it stopped.
+
+    Keeps the songs that can still be picked with their cached scores, the playlist so
+    far (which context dependent raters like RepeaterRater keep their state for) and the
+    random number generator, so topping up a queue only costs the new picks. Everything
+    but the parameters is set up by the first extend."""
+
+    def __init__(self, init_playlist=[], sampling="scan", debug=False, rng=None, tolerance=None):
+        self.init_playlist = list(init_playlist)
+        self.sampling = sampling
+        self.debug = debug
+        # Seconds play_length may be missed by; None to pick until play_length is reached
+        self.tolerance = tolerance
+        # Own generator so other users of random don't change the picks of the session
+        self.random = rng if rng is not None else random.Random(random.getrandbits(64))
+
+        # Length of the queue: init_playlist and all picked songs
+        self.queue_length = sum(song("~#length") for song in self.init_playlist)
+
+        self.features = None
+        self.playlist = None
+        self.static = None
+        self.rate = None
+        self.vectorized = False
+        # WeightedSampler of the remaining songs, or (if vectorized) their indices and scores.
+        # With a tolerance, both are ordered by length; lengths then holds the lengths of the
+        # songs in the sampler.
+        self.sampler = None
+        self.remaining = None
+        self.scores = None
+        self.lengths = None
+        self.rescore = True
+
+    def __len__(self):
+        """Number of songs that can still be picked"""
+        if self.rate is None:
+            return 0
+        elif self.vectorized:
+            return len(self.remaining)
+        return len(self.sampler)
+
+class RatedLibrary():
+    # In rejection sampling, fall back to rating all songs after this many rejected candidates
+    max_rejections = 32
+
+    def __init__(self, library, rater, stats=None, trace=None, index=None):
+        self.library = library
+        self.rater = rater
+        # RaterStats to profile the runs in; None to not profile
+        self.stats = stats
+        # TraceRecorder to explain the picked songs in; None to not explain them (unless debugging)
+        self.trace = trace
+        # FeatureIndex to reuse features and static scores from; None to compute them every run
+        self.index = index
+
+    def __getitem__(self, index):
+        return self.library[index]
+
+    def __iter__(self):
+        return iter(self.library)
+
+    def create_playlist(self, init_playlist=[], num_items=None, play_length=None, debug=False, sampling="scan",
+                        tolerance=None, budget=None):
+        """Return a list of songs picked by iter_playlist. With a budget (in seconds), the
+        picks are then improved for that long (see PlaylistOptimizer)."""
+        session = PlaylistSession(init_playlist, sampling, debug, rng=random, tolerance=tolerance)
+        if play_length is not None:
+            play_length -= session.queue_length
+        playlist = list(self._extend_new(session, num_items, play_length))
+        if budget is None or not playlist:
+            return playlist
+        return self.optimize(session, budget, play_length)
+
+    def iter_playlist(self, init_playlist=[], num_items=None, play_length=None, debug=False, sampling="scan",
+                      tolerance=None):
+        """Pick songs from the library until num_items or play_length is reached, yielding
+        each song as soon as it is picked.
+
+        With sampling="scan", all remaining songs are rated for every pick. With
+        sampling="rejection", candidates are drawn according to the upper bound of their
+        score and accepted with probability score/bound, so only the drawn candidates are
+        rated. Both modes pick songs with exactly the same probabilities.
+
+        If numpy is available, "scan" rates all remaining songs at once using rate_batch.
+
+        With a tolerance (in seconds), play_length is met within the tolerance instead of
+        overshot: once the remaining time gets shorter than the longest songs, only the
+        songs that fit are picked from, with the same weights among them."""
+        session = PlaylistSession(init_playlist, sampling, debug, rng=random, tolerance=tolerance)
+        if play_length is not None:
+            play_length -= session.queue_length
+        return self._extend_new(session, num_items, play_length)
+
+    def _extend_new(self, session, num_items, play_length):
+        if num_items is not None:
+            # iter_playlist has always picked one song more than num_items
+            num_items += 1
+        return self.extend(session, num_items, play_length)
+
+    def create_playlists(self, specs, init_playlist=[], sampling="scan", processes=None):
+        """Return the playlists of several PlaylistSpecs, e.g. variants of the weights or
+        different lengths, picked from the same library.
+
+        Tags are read and static raters rate the library once for all of them (see
+        StaticColumns); the playlists are then picked in a pool of processes. Every
+        playlist only depends on its spec, not on the number of processes."""
+        specs = [PlaylistSpec(*spec) for spec in specs]
+        excluded = set(init_playlist)
+
+        with self._phase("snapshot"):
+            features = SongFeatures(song for song in self.library if song not in excluded)
+        with self._phase("static"):
+            static_columns = StaticColumns(features)
+            statics = [static_columns.static_scores(spec.rater) for spec in specs]
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(specs))
+
+        with self._phase("picking"):
+            if processes <= 1:
+                _init_batch_worker(features, specs, statics, sampling, init_playlist)
+                try:
+                    playlists = map(_create_batch_playlist, range(len(specs)))
+                finally:
+                    _batch_state.clear()
             else:
-                # wasn't able to find a song; this should never be possble
-                raise RuntimeError("Couldn't find song; this should never happen")
-            # the last song, score of the above for loop is the chosen one :D
+                # Forked workers get the snapshot and the static scores without copying
+                pool = multiprocessing.Pool(processes, _init_batch_worker,
+                                            (features, specs, statics, sampling, init_playlist))
+                try:
+                    playlists = pool.map(_create_batch_playlist, range(len(specs)))
+                finally:
+                    pool.terminate()
+
+        return [[features.songs[index] for index in indices] for indices in playlists]
+
+    def session(self, init_playlist=[], sampling="scan", debug=False, tolerance=None):
+        """Start a PlaylistSession after init_playlist; nothing is computed before the first
+        extend"""
+        return PlaylistSession(init_playlist, sampling, debug, tolerance=tolerance)
+
+    def extend(self, session, num_items=None, play_length=None, exclude=()):
+        """Continue picking songs of a PlaylistSession (see iter_playlist) until num_items more
+        songs or play_length more seconds are picked. Songs in exclude (e.g. enqueued by hand
+        in the meantime) aren't picked anymore."""
+        try:
+            if self.stats is not None and hasattr(self.rater, "instrument"):
+                self.rater.instrument(self.stats)
+                try:
+                    for song in self._extend(session, num_items, play_length, exclude):
+                        yield song
+                finally:
+                    self.rater.uninstrument()
+            else:
+                for song in self._extend(session, num_items, play_length, exclude):
+                    yield song
+        finally:
+            # e.g. worker processes of a ParallelRater; the next extend starts them again
+            self.rater.close()
+
+    def optimize(self, session, budget, play_length=None):
+        """Improve the songs picked in session for budget seconds (see PlaylistOptimizer) and
+        return them; the session itself stays as it is. play_length is the one the songs
+        were picked for, if any; replacing songs keeps to it as picking did."""
+        optimizer = PlaylistOptimizer.for_session(self.rater, session, play_length)
+        with self._phase("optimizing"):
+            return optimizer.run(budget)
+
+    def _phase(self, name):
+        """Context manager timing its block as phase name, if profiling"""
+        if self.stats is None:
+            return NO_PHASE
+        return self.stats.phase(name)
+
+    def _start(self, session):
+        """Rate the library for the first extend of session. Features, static scores and
+        a rejection sampler already set on the session (see PlaylistPreview) are used as
+        they are."""
+        if session.debug:
+            print "Total length in Queue: %i" % session.queue_length
+
+        features, static = session.features, session.static
+        if features is None:
+            # remove the songs already in the initial playlist
+            excluded = set(session.init_playlist)
+            songs = (song for song in self.library if song not in excluded)
+            with self._phase("snapshot"):
+                if self.index is not None and hasattr(self.rater, "static_components"):
+                    features, static = self.index.snapshot(songs, self.rater)
+                else:
+                    features = SongFeatures(songs)
+            session.features = features
+        session.playlist = History(features)
+
+        # Scores of raters that don't depend on the playlist never change; only rate them once
+        if static is None:
+            with self._phase("static"):
+                static = self.rater.rate_static(features)
+        elif self.index is not None:
+            with self._phase("index"):
+                self.index.save()
+        session.static = static
+
+        # The rater tree fused into one function for rating single songs
+        session.rate = self.rater.compile(static)
+
+        candidates = xrange(len(features))
+        if session.tolerance is not None:
+            # Songs fitting the remaining time are a prefix of the candidates then
+            candidates = sorted(candidates, key=features.length.__getitem__)
+            session.lengths = array('d', (features.length[index] for index in candidates))
+
+        session.vectorized = session.sampling == "scan" and numpy is not None
+        if session.sampling == "rejection":
+            if session.sampler is None:
+                with self._phase("static"):
+                    bounds = self.rater.upper_bounds(static)
+                    if session.tolerance is not None:
+                        bounds = [bounds[index] for index in candidates]
+                session.sampler = WeightedSampler(candidates, bounds)
+        elif session.vectorized:
+            # remaining song indices and their scores, in the same order
+            session.remaining = numpy.array(candidates, dtype=numpy.intp)
+            session.scores = None
+        elif session.sampling == "scan":
+            session.sampler = WeightedSampler(candidates)
+        else:
+            raise ValueError("Unknown sampling mode: %s" % session.sampling)
+
+        session.rescore = True
+
+    def _exclude(self, session, songs):
+        """Make songs unavailable to session"""
+        indices = [session.features.index[song] for song in songs if song in session.features.index]
+        if session.vectorized:
+            positions = numpy.flatnonzero(numpy.in1d(session.remaining, indices))
+            session.remaining = numpy.delete(session.remaining, positions)
+            if session.scores is not None:
+                session.scores = numpy.delete(session.scores, positions)
+        else:
+            for index in indices:
+                if index in session.sampler:
+                    session.sampler.remove(index)
+
+    def _extend(self, session, num_items, play_length, exclude):
+        if session.rate is None:
+            self._start(session)
+        else:
+            # Profiling may be on or off (or into other stats) than in the last extend
+            session.rate = self.rater.compile(session.static)
+        if exclude:
+            self._exclude(session, exclude)
+
+        features = session.features
+        playlist = session.playlist
+        static = session.static
+        rng = session.random
+        picked = 0
+        picked_length = 0.
+        tolerance = session.tolerance if play_length is not None else None
+        limit = None
+
+        while (len(session) > 0 and       # as long as there's still songs to choose from
+               (num_items is None or picked < num_items) and        # and the total duration is not reached
+               (play_length is None or picked_length < play_length - (tolerance or 0.))):       # and we have not found enough songs
+
+            if tolerance is not None:
+                # Only pick from the songs that don't overshoot play_length by more than tolerance
+                limit = self._fitting(session, play_length + tolerance - picked_length)
+                if not limit:
+                    break
 
-            if debug:
-                # here, score is still the score from the above for loop
+            if session.sampling == "rejection":
+                index, score = self._draw_rejection(session.sampler, session.rate, features, playlist, rng, limit)
+            elif session.vectorized:
+                if session.rescore:
+                    with self._phase("scoring"):
+                        session.scores = numpy.maximum(self.rater.rate_batch(features, session.remaining, playlist, static), 0.)
+                    session.rescore = self.rater.context_dependent
+
+                with self._phase("sampling"):
+                    position = self._draw_position(session.scores[:limit], rng)
+                    index = session.remaining[position]
+                    score = session.scores[position]
+                    session.remaining = numpy.delete(session.remaining, position)
+                    session.scores = numpy.delete(session.scores, position)
+            else:
+                sampler = session.sampler
+                # Rate all songs depending on the current playlist; only touch the weights that changed
+                if session.rescore:
+                    with self._phase("scoring"):
+                        for index in sampler:
+                            score = session.rate(features, index, playlist)
+                            if score != sampler.weight(index):
+                                sampler.update(index, score)
+
+                    # Without context dependent raters, the scores stay the same for all picks
+                    session.rescore = self.rater.context_dependent
+
+                with self._phase("sampling"):
+                    index = sampler.draw(rng.random(), limit)
+                    score = sampler.weight(index)
+
+            # Only the picked song is explained, with the playlist it was picked for
+            if session.debug or self.trace is not None:
+                song = features.songs[index]
+                score, details = self.rater.explain(features, index, playlist, static)
+                if self.trace is not None:
+                    self.trace.record(len(playlist), song, score, details)
+
+            if session.debug:
                 song["~#score_total"] = score
                 # times scores it by 100 to make it more readable
                 print "%s (Total: %i)" % (song("title"), score)
 
-                for rater, score in rating_details[song]["base"].iteritems():
+                for rater, score in details["base"].iteritems():
                     song["~#score_%s" % rater.name.lower()] = score
                     print "    +%.2f (%s)" % (score, rater)
 
-                for rater, score in rating_details[song]["modifier"].iteritems():
+                for rater, score in details["modifier"].iteritems():
                     song["~#score_%s" % rater.name.lower()] = score
                     print "    *%.2f (%s)" % (score, rater)
 
-            songs.remove(song) # Remove this song from the potential songlist
-            playlist.append(song) # Add this song to the playlist
-            total_play_length += song("~#length")
+            if not session.vectorized:
+                session.sampler.remove(index) # Remove this song from the potential songlist
+            playlist.append(features, index) # Add this song to the playlist
+            picked += 1
+            picked_length += features.length[index]
+            session.queue_length += features.length[index]
+
+            yield features.songs[index]
+
+    @staticmethod
+    def _fitting(session, max_length):
+        """Number of leading candidates of a session with a tolerance that are at most
+        max_length long; 0 if none of them is left"""
+        if session.vectorized:
+            limit = numpy.searchsorted(session.features.vector('length')[session.remaining], max_length, side='right')
+            return int(limit)
+
+        limit = bisect.bisect_right(session.lengths, max_length)
+        return limit if session.sampler.count(limit) else 0
+
+    @staticmethod
+    def _draw_position(scores, rng=random):
+        """Draw a position in a numpy array of non-negative scores, proportional to the score"""
+        cumulative = numpy.cumsum(scores)
+        total_score = cumulative[-1]
+        if total_score <= 0.:
+            return int(rng.random() * len(scores))
+
+        position = numpy.searchsorted(cumulative, rng.random() * total_score, side='right')
+        return min(position, len(scores) - 1)
+
+    def _draw_rejection(self, sampler, rate, features, playlist, rng=random, limit=None):
+        """Draw a song from a sampler weighted by score upper bounds; returns its index and score.
+        With limit, only the first limit songs of the sampler are drawn."""
+        for attempt in range(self.max_rejections):
+            with self._phase("sampling"):
+                index = sampler.draw(rng.random(), limit)
+                bound = sampler.weight(index)
+            with self._phase("scoring"):
+                score = rate(features, index, playlist)
+
+            # All bounds being 0 means all scores are 0; every song is equally likely then
+            if bound <= 0. or rng.random() * bound < score:
+                return index, score
+
+        # The acceptance rate collapsed (e.g. most songs would be repetitions); rate all songs
+        # that can score above 0. Accepted candidates follow the score distribution exactly, so
+        # this doesn't bias the pick.
+        with self._phase("scoring"):
+            support = self.rater.support(features, playlist)
+            candidates = sampler if support is None else [index for index in support if index in sampler]
+            if limit is not None:
+                candidates = [index for index in candidates if sampler.position[index] < limit]
+            scores = [(index, max(0., rate(features, index, playlist)))
+                      for index in candidates]
+        total_score = sum(score for _, score in scores)
+
+        if total_score <= 0.:
+            if limit is not None:
+                index = rng.choice([index for index in sampler if sampler.position[index] < limit])
+            else:
+                index = rng.choice(list(sampler))
+            score = 0.
+        else:
+            random_score = rng.random() * total_score
+            current_score = 0.
+            for index, score in scores:
+                current_score += score
+                if current_score >= random_score:
+                    break
+
+        return index, score
+
+class PlaylistOptimizer(object):
+    """Improve a picked playlist by local search, for as long as the caller can wait.
+
+    Picking never revisits a pick, so e.g. a song that forces the next ones to repeat its
+    genre stays in the playlist. The optimizer tries random moves: swapping two songs of
+    the playlist, or replacing one by a song drawn from the library according to the upper
+    bound of its score. Moves that don't lower the total score (the scores of all songs,
+    each rated after the songs before it) are kept. Only the songs whose score a move can
+    change are rated again (see Rater.reach), so a move costs a few ratings.
+
+    Since no move lowers the total, the playlist is the best one found so far whenever
+    run returns, and run can be called again to continue.
+
+    The songs to draw replacements from are set up when the optimizer is created, which
+    isn't part of any budget. With numpy, that is a few vectorized operations; without it,
+    the WeightedSampler of a session sampled by rejection is copied (see for_session), but
+    otherwise one is built over the whole library, which takes as long as a pick in scan
+    mode."""
+
+    # Share of the moves that swap two songs; the others replace one
+    swap_rate = 0.5
+
+    def __init__(self, rater, features, static, indices, rng=random, min_length=None, max_length=None,
+                 sampler=None):
+        self.rater = rater
+        self.features = features
+        self.static = static
+        self.rate = rater.compile(static)
+        self.random = rng
+
+        self.indices = list(indices)
+        self.chosen = set(self.indices)
+        self.length = sum(features.length[index] for index in self.indices)
+        # Replacements keep the length of the playlist between these (or the current length)
+        self.min_length = 0. if min_length is None else min(min_length, self.length)
+        self.max_length = float('inf') if max_length is None else max(max_length, self.length)
+
+        self.scores = [self._score(position) for position in xrange(len(self.indices))]
+        self.total = sum(self.scores)
+        self.moves = 0
+        self.improvements = 0
+
+        # The songs replacements are drawn from, weighted by the upper bound of their score;
+        # 0 for the songs in the playlist. With numpy, the bounds and weights of all songs
+        # and the cumulative sum of the weights (None when outdated); otherwise a WeightedSampler and the weights
+        # of the songs in the playlist, to restore once they are replaced.
+        if numpy is not None:
+            self.bounds = rater.upper_bounds(static)
+            self.weights = self.bounds.copy()
+            self.weights[list(self.chosen)] = 0.
+            self.cumulative = None
+        else:
+            if sampler is not None:
+                # Songs picked before aren't in it
+                self.sampler = sampler.copy()
+                self.parked = {}
+            else:
+                bounds = rater.upper_bounds(static)
+                self.sampler = WeightedSampler(xrange(len(features)), bounds)
+                self.parked = dict((index, bounds[index]) for index in self.chosen)
+            for index in self.chosen:
+                if index in self.sampler:
+                    self.sampler.update(index, 0.)
+
+    @classmethod
+    def for_session(cls, rater, session, play_length=None):
+        """Optimizer for the songs picked in a PlaylistSession (see RatedLibrary.optimize)"""
+        min_length = max_length = None
+        if play_length is not None:
+            tolerance = session.tolerance
+            min_length = play_length - (tolerance or 0.)
+            if tolerance is not None:
+                max_length = play_length + tolerance
+            else:
+                # Picking overshot play_length; replacing may not overshoot more
+                max_length = sum(session.features.length[index] for index in session.playlist.indices)
+        # Rejection sampling already weighs the songs not picked by their upper bounds
+        sampler = session.sampler if session.sampling == "rejection" else None
+        return cls(rater, session.features, session.static, session.playlist.indices,
+                   session.random, min_length, max_length, sampler)
+
+    def playlist(self):
+        """The songs of the best playlist found so far"""
+        return [self.features.songs[index] for index in self.indices]
+
+    def run(self, budget):
+        """Try moves for budget seconds; return the best playlist found so far"""
+        deadline = time.time() + budget
+        while self.indices and time.time() < deadline:
+            self.step()
+        return self.playlist()
+
+    def step(self):
+        """Try one random move; return whether it was kept"""
+        size = len(self.indices)
+        if size > 1 and self.random.random() < self.swap_rate:
+            first, second = self.random.sample(xrange(size), 2)
+            return self._try([(first, self.indices[second]), (second, self.indices[first])])
+
+        position = self.random.randrange(size)
+        index = self._draw_replacement()
+        if index is None:
+            return False
+        length = self.length - self.features.length[self.indices[position]] + self.features.length[index]
+        if not self.min_length <= length <= self.max_length:
+            return False
+        return self._try([(position, index)])
+
+    def _try(self, changes):
+        """Put the songs at the positions given as (position, index); keep them if the total
+        doesn't get lower"""
+        self.moves += 1
+        replaced = [(position, self.indices[position]) for position, _ in changes]
+        for position, index in changes:
+            self.indices[position] = index
+
+        affected = set()
+        for position, _ in changes:
+            affected.update(xrange(position, self.rater.reach(self.features, self.indices, position) + 1))
+        affected = sorted(affected)
+        scores = [self._score(position) for position in affected]
+        difference = sum(scores) - sum(self.scores[position] for position in affected)
+
+        if difference < 0.:
+            for position, index in replaced:
+                self.indices[position] = index
+            return False
+
+        for position, score in zip(affected, scores):
+            self.scores[position] = score
+        self.total += difference
+        if difference > 0.:
+            self.improvements += 1
+
+        if len(changes) == 1:
+            (position, index), (_, old_index) = changes[0], replaced[0]
+            self.chosen.remove(old_index)
+            self.chosen.add(index)
+            self._swap_weights(old_index, index)
+            self.length += self.features.length[index] - self.features.length[old_index]
+        return True
+
+    def _score(self, position):
+        """Score of the song at position, after the songs before it"""
+        history = History(self.features, self.indices[:position])
+        return max(0., self.rate(self.features, self.indices[position], history))
+
+    def _draw_replacement(self):
+        """A song not in the playlist, drawn according to the upper bounds; None if that failed"""
+        if numpy is not None:
+            if self.cumulative is None:
+                self.cumulative = numpy.cumsum(self.weights)
+            if not len(self.cumulative) or self.cumulative[-1] <= 0.:
+                # No song outside the playlist can score above 0; all are drawn alike
+                index = self.random.randrange(len(self.features))
+            else:
+                index = int(numpy.searchsorted(self.cumulative, self.random.random() * self.cumulative[-1], side='right'))
+                index = min(index, len(self.cumulative) - 1)
+        elif len(self.sampler):
+            # If no song outside the playlist can score above 0, all are drawn alike
+            index = self.sampler.draw(self.random.random())
+        else:
+            return None
+        return None if index in self.chosen else index
+
+    def _swap_weights(self, old_index, index):
+        """Make old_index (replaced by index) available to be drawn again, and index not"""
+        if numpy is not None:
+            self.weights[old_index], self.weights[index] = self.bounds[old_index], 0.
+            self.cumulative = None
+            return
+
+        bound = self.parked.pop(old_index, None)
+        if bound is not None and old_index in self.sampler:
+            self.sampler.update(old_index, bound)
+        self.parked[index] = self.sampler.weight(index)
+        self.sampler.update(index, 0.)
+
+class StaticColumns(object):
+    """Unweighted scores of static raters for all songs of a snapshot, cached by rater
+    config: rater trees sharing components (e.g. only differing in weights) rate them once"""
+
+    def __init__(self, features):
+        self.features = features
+        # rater config -> column of unweighted scores
+        self.columns = {}
+
+    def static_scores(self, rater):
+        """Like rater.rate_static, from the cached columns"""
+        static = StaticScores(len(self.features))
+        for kind, weight, component in rater.static_components():
+            key = component.config()
+            if key not in self.columns:
+                self.columns[key] = AveragedRater._rate_column(self.features, 1., component)
+
+            if numpy is not None:
+                column = weight * self.columns[key]
+            else:
+                column = array('d', (weight * score for score in self.columns[key]))
+            static.details[kind][component] = column
+            if kind == "base":
+                static.base = elementwise(operator.add, static.base, column)
+            else:
+                static.modifier = elementwise(operator.mul, static.modifier, column)
+
+        return static
+
+    def retain(self, rater):
+        """Forget the columns rater doesn't use"""
+        keys = set(component.config() for _, _, component in rater.static_components())
+        self.columns = dict((key, column) for key, column in self.columns.iteritems() if key in keys)
+
+class PlaylistPreview(object):
+    """The first picks and the score distribution of playlists of songs, quick enough to
+    follow the sliders of the preferences.
+
+    Tags are read once. The unweighted columns of the static raters are cached (see
+    StaticColumns), so changing a weight only reweights cached columns; changing e.g. the
+    tempo target only rates that one rater again. Picks use a fixed seed, so only the
+    weights change them. Without numpy, they are drawn by rejection from a
+    CumulativeSampler, as setting up a WeightedSampler would take longer than all the rest."""
+
+    def __init__(self, songs, num_items=20, seed=0):
+        self.features = SongFeatures(songs)
+        self.num_items = num_items
+        self.seed = seed
+        self.static_columns = StaticColumns(self.features)
+
+    def update(self, rater, bins=10):
+        """Return the first picks for rater and the distribution of the static scores as
+        (highest score, number of songs scoring 0, counts of songs per bin up to the highest)"""
+        static = self.static_columns.static_scores(rater)
+        # Only keep what the current preferences use
+        self.static_columns.retain(rater)
+
+        session = PlaylistSession(sampling="scan" if numpy is not None else "rejection",
+                                  rng=random.Random(self.seed))
+        session.features = self.features
+        session.static = static
+        if numpy is None:
+            session.sampler = CumulativeSampler(xrange(len(self.features)), rater.upper_bounds(static))
+        picks = list(RatedLibrary(self.features.songs, rater).extend(session, num_items=self.num_items))
+
+        if numpy is not None:
+            scores = numpy.maximum(static.base * static.modifier, 0.)
+            top = scores.max() if len(scores) else 0.
+            positive = scores[scores > 0.]
+            counts = list(numpy.histogram(positive, bins=bins, range=(0., top or 1.))[0])
+            return picks, (top, len(scores) - len(positive), counts)
+
+        scores = [max(0., base * modifier) for base, modifier in zip(static.base, static.modifier)]
+        top = max(scores) if scores else 0.
+        counts = [0] * bins
+        zero = 0
+        for score in scores:
+            if score <= 0.:
+                zero += 1
+            else:
+                counts[min(bins - 1, int(score / top * bins))] += 1
+
+        return picks, (top, zero, counts)
+
+def build_rater(weights):
+    """The rater tree of the plugin for a dict of weights (see WeightedPlaylist.options)"""
+    rater = ModifiedAveragedRater()
+    # Raters are a weighted sum
+    rater.add_rater(weight=weights["rating"], rater=SongRatingRater())
+    rater.add_rater(weight=weights["tempo"], rater=BpmRater(target_bpm=weights["tempo_target"], spread=weights["tempo_spread"])) # Variety is between 0 and 50
+    rater.add_rater(weight=weights["transition"], rater=BpmTransitionRater())
+    # Modifiers work multiplicatively
+    rater.add_modifier(weight=3., rater=RepeaterRater())
+
+    return rater
+
+#####################################
+# Headless use on library dumps, see main
 
-        return playlist
+class DumpSong(dict):
+    """Song of a library dump, answering calls like Quod Libet's AudioFile for the keys the
+    raters use"""
+    __hash__ = object.__hash__
+
+    # dump column -> song key
+    keys = {"path": "~filename", "bpm": "bpm", "rating": "~#rating", "length": "~#length",
+            "genre": "genre", "artist": "artist", "title": "title"}
+
+    @classmethod
+    def from_row(cls, row):
+        song = cls()
+        for column, value in row.iteritems():
+            if value not in ("", None) and column in cls.keys:
+                song[cls.keys[column]] = value
+        return song
+
+    # Numeric values of songs without them (or with something else than a number); Quod
+    # Libet rates unrated songs in the middle
+    numeric_defaults = {"~#rating": 0.5, "~#length": 0.}
+
+    def __call__(self, key, default=""):
+        if key.startswith("~#"):
+            for stored in (key, key[2:]):
+                try:
+                    return float(self[stored])
+                except (KeyError, ValueError):
+                    pass
+            return self.numeric_defaults.get(key, default)
+        return self.get(key, default)
+
+    def row(self):
+        """The song as a dump row"""
+        return dict((column, self[key]) for column, key in self.keys.iteritems() if key in self)
+
+def load_library(fileobj, format):
+    """Read all songs of a JSONL or CSV library dump"""
+    if format == "csv":
+        import csv
+        return [DumpSong.from_row(dict((column, _decoded(value)) for column, value in row.iteritems()))
+                for row in csv.DictReader(fileobj)]
+    return [DumpSong.from_row(json.loads(line)) for line in fileobj if line.strip()]
+
+def _decoded(value):
+    """A CSV cell as unicode, like JSON strings; left as bytes if it isn't UTF-8, like Quod
+    Libet's file names"""
+    try:
+        return value.decode("utf-8")
+    except (AttributeError, UnicodeDecodeError):
+        return value
+
+class M3uWriter(object):
+    """Write playlists as extended M3U, one song at a time. Several playlists in one file
+    are simply concatenated."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.fileobj.write("#EXTM3U\n")
+
+    def write(self, number, position, song):
+        title = " - ".join(_utf8(value) for value in (song("artist"), song("title")) if value)
+        self.fileobj.write("#EXTINF:%i,%s\n%s\n" % (song("~#length", 0), title, _utf8(song("~filename"))))
+
+class JsonlWriter(object):
+    """Write playlists as JSON lines: the dump row of each song with its playlist and position.
+    Values that weren't UTF-8 in the dump are written as if they were latin-1."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, number, position, song):
+        row = song.row()
+        row.update(playlist=number, position=position)
+        self.fileobj.write(json.dumps(row, sort_keys=True, encoding="latin-1") + "\n")
+
+def _utf8(text):
+    return text.encode("utf-8") if isinstance(text, unicode) else text
+
+def main(argv):
+    """Create playlists from a library dump without Quod Libet"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Create weighted playlists from a JSONL or CSV library dump with the columns "
+                    "path, bpm, rating, length, genre, artist (and optionally title).")
+    parser.add_argument("input", help="library dump; - for standard input")
+    parser.add_argument("--format", choices=("jsonl", "csv"),
+                        help="format of the dump (default: by extension, else jsonl)")
+    parser.add_argument("--output", default="-",
+                        help="file to write to (default: standard output); with several playlists, "
+                             "{n} in the name is replaced by the number of the playlist")
+    parser.add_argument("--output-format", choices=("m3u", "jsonl"),
+                        help="format of the playlists (default: by extension, else m3u)")
+    parser.add_argument("--playlists", type=int, default=1, help="number of playlists (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first playlist; the next ones count up (default: %(default)s)")
+    parser.add_argument("--num-items", type=int, help="songs per playlist")
+    parser.add_argument("--play-length", type=float, help="seconds per playlist")
+    parser.add_argument("--tolerance", type=float, help="seconds --play-length may be missed by")
+    parser.add_argument("--sampling", choices=("scan", "rejection"), default="rejection")
+    parser.add_argument("--processes", type=int, help="processes for several playlists (default: all CPUs)")
+    parser.add_argument("--optimize", type=float, metavar="SECONDS",
+                        help="improve each playlist for this long after picking it")
+    parser.add_argument("--rating", type=float, default=60., help="weight of the rating (default: %(default)s)")
+    parser.add_argument("--tempo", type=float, default=30., help="weight of the tempo (default: %(default)s)")
+    parser.add_argument("--tempo-target", type=float, default=95., help="average tempo (default: %(default)s)")
+    parser.add_argument("--tempo-spread", type=float, default=20., help="spread of tempo (default: %(default)s)")
+    parser.add_argument("--transition", type=float, default=0.,
+                        help="weight of smooth tempo transitions (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.num_items is None and args.play_length is None:
+        parser.error("give --num-items, --play-length or both")
+
+    input_format = args.format or ("csv" if args.input.endswith(".csv") else "jsonl")
+    if args.input == "-":
+        library = load_library(sys.stdin, input_format)
+    else:
+        with open(args.input, "rb") as fileobj:
+            library = load_library(fileobj, input_format)
+
+    output_format = args.output_format or ("jsonl" if args.output.endswith(".jsonl") else "m3u")
+    writer_class = JsonlWriter if output_format == "jsonl" else M3uWriter
+
+    weights = {"rating": args.rating, "tempo": args.tempo, "tempo_target": args.tempo_target,
+               "tempo_spread": args.tempo_spread, "transition": args.transition}
+    rated_library = RatedLibrary(library, build_rater(weights))
+    seeds = range(args.seed, args.seed + args.playlists)
+
+    if args.playlists == 1:
+        # Written while they are picked, unless they are improved afterwards
+        session = PlaylistSession(sampling=args.sampling, rng=random.Random(args.seed), tolerance=args.tolerance)
+        playlist = rated_library.extend(session, args.num_items, args.play_length)
+        if args.optimize is not None:
+            for song in playlist:
+                pass
+            playlist = rated_library.optimize(session, args.optimize, args.play_length)
+        playlists = [playlist]
+    else:
+        # Specs pick one song more than num_items, like create_playlist
+        num_items = args.num_items - 1 if args.num_items is not None else None
+        specs = [PlaylistSpec(build_rater(weights), seed, num_items, args.play_length, args.tolerance,
+                              args.optimize)
+                 for seed in seeds]
+        playlists = rated_library.create_playlists(specs, sampling=args.sampling, processes=args.processes)
+
+    output = None
+    try:
+        for number, playlist in zip(seeds, playlists):
+            if output is None or "{n}" in args.output:
+                if output is not None:
+                    output.close()
+                output = sys.stdout if args.output == "-" else open(args.output.replace("{n}", str(number)), "w")
+                writer = writer_class(output)
+            for position, song in enumerate(playlist):
+                writer.write(number, position, song)
+    finally:
+        if output is not None and output is not sys.stdout:
+            output.close()
+
+    return 0
 
 def test(library):
     rater = ModifiedAveragedRater()
@@ -237,9 +2539,9 @@ def test(library):
 
     print playlist
 
-if __name__ == '__main__':
-    import random
-
+if __name__ == '__main__' and len(sys.argv) > 1:
+    sys.exit(main(sys.argv[1:]))
+elif __name__ == '__main__':
     class FakeSong:
         def __init__(self):
             self.seen = {}
@@ -252,6 +2554,9 @@ if __name__ == '__main__':
                 self.seen[arg] = val
                 return val
 
+        def __setitem__(self, arg, val):
+            self.seen[arg] = val
+
         def __call__(self, arg):
             return self[arg]
 
@@ -267,6 +2572,73 @@ if __name__ == '__main__':
 
 #####################################
 # Quod Libet Plugin
+class PlaylistWorker(threading.Thread):
+    """Run a playlist generator (see RatedLibrary.iter_playlist) in a background thread.
+
+    The callbacks are called from the GTK main loop: on_songs with each chunk of picked
+    songs, on_progress with the fraction of play_length (or num_items) picked so far and
+    on_done once the generator is exhausted or cancelled. After cancel(), no more songs
+    are handed out."""
+
+    def __init__(self, playlist, on_songs, on_progress=None, on_done=None,
+                 play_length=None, num_items=None, first_chunk=3, chunk_size=20):
+        super(PlaylistWorker, self).__init__(name="weighted playlist")
+        self.daemon = True
+
+        self.playlist = playlist
+        self.on_songs = on_songs
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.play_length = play_length
+        self.num_items = num_items
+        self.first_chunk = first_chunk
+        self.chunk_size = chunk_size
+
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        chunk = []
+        chunk_size = self.first_chunk
+        picked_length = 0.
+        try:
+            for picked, song in enumerate(self.playlist, 1):
+                if self.cancelled.is_set():
+                    return
+
+                chunk.append(song)
+                picked_length += song("~#length")
+                if len(chunk) >= chunk_size:
+                    GLib.idle_add(self._deliver, chunk, self._progress(picked, picked_length))
+                    chunk = []
+                    chunk_size = self.chunk_size
+
+            if chunk:
+                GLib.idle_add(self._deliver, chunk, 1.)
+        finally:
+            GLib.idle_add(self._done)
+
+    def _progress(self, picked, picked_length):
+        if self.play_length:
+            return min(1., picked_length / self.play_length)
+        elif self.num_items:
+            return min(1., float(picked) / self.num_items)
+        return 0.
+
+    def _deliver(self, songs, progress):
+        if not self.cancelled.is_set():
+            self.on_songs(songs)
+            if self.on_progress is not None:
+                self.on_progress(progress)
+        return False
+
+    def _done(self):
+        if self.on_done is not None:
+            self.on_done()
+        return False
+
 class WeightedPlaylist(SongsMenuPlugin):
     PLUGIN_ID = "weightedplaylist"
     PLUGIN_NAME = _("Weighted playlist from selection")
@@ -278,6 +2650,7 @@ class WeightedPlaylist(SongsMenuPlugin):
         "weights": [
             ("rating", _("Rated higher")),
             ("tempo", _("Importance of tempo")),
+            ("transition", _("Smooth tempo transitions")),
             ("lastplayed", _("Played more recently"))
         ],
         "values": [
@@ -289,50 +2662,132 @@ class WeightedPlaylist(SongsMenuPlugin):
     # configuration values
     weights = {}
 
+    # Number of songs enqueued right away; the rest is enqueued in chunks as they are picked
+    first_chunk = 3
+    chunk_size = 20
+
+    # Length of the queue to fill up to; with top_up = False, length to add to the queue
+    play_length = 5*60*60
+    top_up = True
+    # Seconds the queue may end up shorter or longer than that
+    tolerance = 2*60
+
+    # PlaylistWorker of the last run; cancelled when the plugin is triggered again
+    worker = None
+
+    # Last PlaylistSession as (selection, rater config, RatedLibrary, session); the next run
+    # with the same selection and preferences continues it
+    session = None
+
+    # FeatureIndex shared by all runs; loaded when the plugin module is
+    index = None
+    # Milliseconds the index waits for more library changes before saving them
+    index_flush_delay = 1000
+
+    @classmethod
+    def feature_index(cls):
+        if WeightedPlaylist.index is None:
+            index = FeatureIndex(os.path.join(const.USERDIR, "weightedplaylist.index"))
+            # Tag edits (and bpm saved by the BPM Tagger) only update the songs they touch,
+            # and are saved soon after so they survive a restart
+            index.watch(app.library, lambda flush: GLib.timeout_add(cls.index_flush_delay, flush))
+            WeightedPlaylist.index = index
+        return WeightedPlaylist.index
+
+    # Milliseconds the preview waits for the sliders to settle
+    preview_delay = 30
+
     def __init__(self, songs, library):
         super(WeightedPlaylist, self).__init__(songs, library)
 
-        for key,_ in self.options["weights"]:
-            val = config.getfloat("plugins", "weightedlibrary_%s" % key, 0.0)
-            self.weights[key] = val
-        for key,_,min_value,max_value in self.options["values"]:
-            val = config.getfloat("plugins", "weightedlibrary_%s" % key, (min_value+max_value)/2.)
-            self.weights[key] = val
-
+        self.load_weights()
 
         for key,val in self.weights.items():
             print "%s = %s" % (key,val)
 
-        rater = ModifiedAveragedRater()
-        # Raters are a weighted sum
-        rater.add_rater(weight=self.weights["rating"], rater=SongRatingRater())
-        rater.add_rater(weight=self.weights["tempo"], rater=BpmRater(target_bpm=self.weights["tempo_target"], spread=self.weights["tempo_spread"])) # Variety is between 0 and 50
-        # Modifiers work multiplicatively
-        rater.add_modifier(weight=3., rater=RepeaterRater())
+        self.rater = self.build_rater()
 
-        self.rater = rater
+    @classmethod
+    def load_weights(cls):
+        for key,_ in cls.options["weights"]:
+            val = config.getfloat("plugins", "weightedlibrary_%s" % key, 0.0)
+            cls.weights[key] = val
+        for key,_,min_value,max_value in cls.options["values"]:
+            val = config.getfloat("plugins", "weightedlibrary_%s" % key, (min_value+max_value)/2.)
+            cls.weights[key] = val
 
-    def plugin_songs(self, songs):
-        # Initiate a RatedLibrary with the given (selected) songs
-        self.rated_library = RatedLibrary(songs, self.rater)
+    @classmethod
+    def build_rater(cls):
+        """The rater tree for the current weights"""
+        return build_rater(cls.weights)
 
-        # Create a playlist out of the selected songs that lasts at least 5 hours
+    def plugin_songs(self, songs):
+        # Only one playlist at a time; stop the one still being generated. Its session can't
+        # be continued, it may have picked songs that were never enqueued.
+        if WeightedPlaylist.worker is not None and WeightedPlaylist.worker.is_alive():
+            WeightedPlaylist.worker.cancel()
+            WeightedPlaylist.session = None
+
+        # Profiling is opt-in; the summary is printed when the playlist is done
+        stats = None
+        if config.getboolean("plugins", "weightedlibrary_profile", False):
+            stats = RaterStats()
+
+        # Fill the queue up to play_length (e.g. 5 hours) with the selected songs
         current_queue = list(app.window.playlist.q.itervalues()) # Make a copy
-        playlist = self.rated_library.create_playlist(init_playlist=current_queue, play_length=5*60*60)
-
-        # Append to current queue
-        app.window.playlist.enqueue(playlist)
+        if self.top_up:
+            play_length = self.play_length - sum(song("~#length") for song in current_queue)
+        else:
+            play_length = self.play_length
+
+        # Continue the last session if nothing changed; only the new picks are rated then
+        selection = set(songs)
+        rater_config = self.rater.config()
+        if WeightedPlaylist.session is not None and WeightedPlaylist.session[:2] == (selection, rater_config):
+            self.rated_library, session = WeightedPlaylist.session[2:]
+            self.rated_library.stats = stats
+        else:
+            # Initiate a RatedLibrary with the given (selected) songs
+            self.rated_library = RatedLibrary(songs, self.rater, stats, index=self.feature_index())
+            session = self.rated_library.session(init_playlist=current_queue, sampling="rejection",
+                                                 tolerance=self.tolerance)
+            WeightedPlaylist.session = (selection, rater_config, self.rated_library, session)
+
+        # Songs enqueued by hand since the last run aren't picked again
+        playlist = self.rated_library.extend(session, play_length=play_length, exclude=current_queue)
+
+        # Generate in the background and append to current queue as songs come in
+        worker = PlaylistWorker(playlist, app.window.playlist.enqueue, play_length=play_length,
+                                first_chunk=self.first_chunk, chunk_size=self.chunk_size)
+        task = Task(_("Weighted playlist"), _("Generating queue"), stop=worker.cancel)
+        worker.on_progress = task.update
+
+        def done():
+            task.finish()
+            if worker.cancelled.is_set() and WeightedPlaylist.session is not None and WeightedPlaylist.session[3] is session:
+                WeightedPlaylist.session = None
+            if stats is not None:
+                print stats.summary()
+        worker.on_done = done
+
+        WeightedPlaylist.worker = worker
+        worker.start()
 
         return True
 
     # we need to use classmethod since we're not an EventPlugin and are not instanciated until we're called.
     @classmethod
     def PluginPreferences(cls, plugin_container):
+        cls.load_weights()
+
         # Almost copied identically from randomalbum plugin
         def changed_cb(hscale, key):
             val = hscale.get_value()
             cls.weights[key] = val
             config.set("plugins", "weightedlibrary_%s" % key, val)
+            # Sessions are rated with the old preferences
+            WeightedPlaylist.session = None
+            schedule_preview()
 
         vbox = Gtk.VBox(spacing=12)
         table = Gtk.Table(n_rows=(len(cls.options["weights"])+2*len(cls.options["values"])+2) + 1, n_columns=3)
@@ -417,7 +2872,48 @@ class WeightedPlaylist(SongsMenuPlugin):
                          xpadding=3, ypadding=3)
             idx += 1
 
+        # Preview of the songs in the song list with the current weights
+        preview_label = Gtk.Label()
+        preview_label.set_alignment(0, 0)
+        preview_label.set_selectable(True)
+        frame = Gtk.Frame(label=_("Preview"))
+        frame.add(preview_label)
+        vbox.pack_start(frame, True, True, 0)
+
+        preview = PlaylistPreview(app.window.songlist.get_songs())
+        # Source id of the pending update; dragging a slider only postpones it
+        pending = []
+
+        def update_preview():
+            del pending[:]
+            picks, (top, zero, counts) = preview.update(cls.build_rater())
+
+            lines = ["<b>%s</b>" % util.escape(_("Next songs"))]
+            for song in picks:
+                lines.append(util.escape("%s - %s" % (song("artist"), song("title"))))
 
+            lines.append("")
+            lines.append("<b>%s</b>" % util.escape(_("Score distribution")))
+            lines.append("<tt>%10s %6i</tt>" % ("0", zero))
+            widest = max(counts + [1])
+            for i, count in enumerate(counts):
+                bar = "#" * int(round(20. * count / widest))
+                lines.append("<tt>%10.4g %6i %s</tt>" % (top * (i + 1) / len(counts), count, bar))
+
+            preview_label.set_markup("\n".join(lines))
+            return False
+
+        def schedule_preview():
+            if pending:
+                GLib.source_remove(pending.pop())
+            pending.append(GLib.timeout_add(cls.preview_delay, update_preview))
+
+        def destroy_cb(widget):
+            if pending:
+                GLib.source_remove(pending.pop())
+        vbox.connect("destroy", destroy_cb)
+
+        update_preview()
 
         return vbox
 
@@ -437,3 +2933,18 @@ class WeightedPlaylistAll(WeightedPlaylist):
         # Call parent method with current songlist instead of selected songs
         return super(WeightedPlaylistAll, self).plugin_songs(songlist_songs)
 
+class WeightedPlaylistExtend(WeightedPlaylist):
+    """Same as WeightedPlaylist but add an hour to the queue, however long it is already."""
+
+    PLUGIN_ID = "weightedplaylistextend"
+    PLUGIN_NAME = _("Extend weighted playlist by an hour")
+    PLUGIN_ICON = "gtk-media-next"
+    PLUGIN_DESC = _("From a selection of songs, enqueue another hour of the last weighted playlist.")
+
+    play_length = 60*60
+    top_up = False
+
+if app is not None and getattr(app, "library", None) is not None:
+    # Watch the library from the start, so tag edits made before the first playlist (e.g.
+    # by the BPM Tagger) reach the index too
+    WeightedPlaylist.feature_index()